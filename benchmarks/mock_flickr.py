@@ -0,0 +1,689 @@
+"""Local stand-in for the Flickr REST and upload API
+
+Implements the methods used by flickr_api_utils with an in-memory library, so the
+commands can be run (and timed) without network. Point the tool at it with:
+
+    python -m benchmarks.mock_flickr --photos 1000 --albums 50
+    FAU_API_URL=http://127.0.0.1:8765 python -m flickr_api_utils ...
+
+Not a faithful reproduction of Flickr: only the fields read by the tool are returned,
+and the OAuth signature is not checked.
+"""
+
+from datetime import datetime
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import json
+import logging
+import random
+import shlex
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import xml.etree.ElementTree as ET
+
+import click
+
+from flickr_api_utils.exif_utils import read_date_taken
+from flickr_api_utils.flickr_utils import to_flickr_date
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 500
+
+USER_ID = "00000000@N00"
+USERNAME = "mock"
+
+
+class MockFlickrError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class MockConfig:
+    """Simulated server behaviour
+
+    latency: seconds added to each REST call
+    upload_bandwidth: bytes/s for the upload body (0: no limit)
+    ticket_delay: seconds before an async upload ticket is complete
+    max_per_page: max number of items per page
+    error_rate: probability of a 500 error for each call
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        upload_bandwidth=0,
+        ticket_delay=0.0,
+        max_per_page=MAX_PER_PAGE,
+        error_rate=0.0,
+    ):
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+        self.ticket_delay = ticket_delay
+        self.max_per_page = max_per_page
+        self.error_rate = error_rate
+
+
+class MockLibrary:
+    """Photos and albums of the mock user"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.lock = threading.RLock()
+        self._ids = itertools.count(10_000_000_000)
+        self._tag_ids = itertools.count(1)
+        self.photos = {}
+        # in user order
+        self.albums = {}
+        self.tickets = {}
+        # counts by method: for the benchmark reports
+        self.calls = {}
+
+    def next_id(self):
+        return str(next(self._ids))
+
+    def add_photo(self, title, tags, date_taken, date_upload=None, is_public=0):
+        photo_id = self.next_id()
+        self.photos[photo_id] = dict(
+            id=photo_id,
+            title=title or "",
+            description="",
+            tags=[(str(next(self._tag_ids)), tag) for tag in tags],
+            datetaken=date_taken,
+            dateupload=int(date_upload or time.time()),
+            lastupdate=int(time.time()),
+            ispublic=int(is_public),
+            latitude=0,
+            longitude=0,
+            views=0,
+        )
+        return photo_id
+
+    def add_album(self, title, primary_photo_id, description=""):
+        album_id = self.next_id()
+        now = int(time.time())
+        self.albums[album_id] = dict(
+            id=album_id,
+            title=title,
+            description=description,
+            primary=primary_photo_id,
+            photo_ids=[primary_photo_id],
+            date_create=now,
+            date_update=now,
+        )
+        # new albums at the top like Flickr
+        self.albums = {album_id: self.albums.pop(album_id), **self.albums}
+        return album_id
+
+    def populate(self, num_photos, num_albums, seed=0):
+        rnd = random.Random(seed)
+        start = datetime(2015, 1, 1).timestamp()
+        photo_ids = []
+        for i in range(num_photos):
+            taken = datetime.fromtimestamp(start + rnd.randrange(10 * 365 * 86400))
+            photo_ids.append(
+                self.add_photo(
+                    f"Photo {i}",
+                    [f"tag{rnd.randrange(50)}", f"place{rnd.randrange(20)}"],
+                    taken.strftime("%Y-%m-%d %H:%M:%S"),
+                    date_upload=start + i,
+                    is_public=1,
+                )
+            )
+        for i in range(num_albums):
+            size = rnd.randint(1, max(1, min(200, num_photos)))
+            album_photo_ids = rnd.sample(photo_ids, min(size, len(photo_ids)))
+            if not album_photo_ids:
+                continue
+            album_id = self.add_album(f"Album {i}", album_photo_ids[0])
+            self.albums[album_id]["photo_ids"] = album_photo_ids
+
+
+def _page(items, params, config):
+    per_page = min(int(params.get("per_page", DEFAULT_PER_PAGE)), config.max_per_page)
+    page = int(params.get("page", 1))
+    total = len(items)
+    pages = max(1, -(-total // per_page))
+    start = (page - 1) * per_page
+    return (
+        dict(page=page, pages=pages, perpage=per_page, total=total),
+        items[start : start + per_page],
+    )
+
+
+def _extras(photo, extras):
+    data = dict(id=photo["id"], title=photo["title"], owner=USER_ID)
+    extras = set(filter(None, extras.split(",")))
+    data.update(ispublic=photo["ispublic"], isfriend=0, isfamily=0)
+    if "date_taken" in extras:
+        data.update(datetaken=photo["datetaken"], datetakengranularity=0)
+    if "date_upload" in extras:
+        data.update(dateupload=str(photo["dateupload"]))
+    if "last_update" in extras:
+        data.update(lastupdate=str(photo["lastupdate"]))
+    if "tags" in extras:
+        data.update(tags=" ".join(_normalize_tag(raw) for _, raw in photo["tags"]))
+    if "geo" in extras:
+        data.update(latitude=photo["latitude"], longitude=photo["longitude"])
+    if "views" in extras:
+        data.update(views=str(photo["views"]))
+    if "owner_name" in extras:
+        data.update(ownername=USERNAME)
+    if "path_alias" in extras:
+        data.update(pathalias=USERNAME)
+    if "url_o" in extras:
+        data.update(url_o=f"http://localhost/photos/{photo['id']}_o.jpg")
+    return data
+
+
+def _normalize_tag(raw):
+    return "".join(c for c in raw.lower() if c.isalnum())
+
+
+class MockFlickrApi:
+    """REST methods: flickr.x.y => method x_y with the request parameters"""
+
+    def __init__(self, library: MockLibrary):
+        self.library = library
+        self.config = library.config
+
+    def call(self, method, params):
+        name = method.removeprefix("flickr.").replace(".", "_")
+        func = getattr(self, name, None)
+        if not func:
+            raise MockFlickrError(112, f'Method "{method}" not found')
+        with self.library.lock:
+            self.library.calls[method] = self.library.calls.get(method, 0) + 1
+            return func(params)
+
+    def _photo(self, photo_id):
+        photo = self.library.photos.get(photo_id)
+        if not photo:
+            raise MockFlickrError(1, "Photo not found")
+        return photo
+
+    def _album(self, album_id):
+        album = self.library.albums.get(album_id)
+        if not album:
+            raise MockFlickrError(1, "Photoset not found")
+        return album
+
+    def _touch(self, album):
+        album["date_update"] = int(time.time())
+
+    # auth
+
+    def auth_oauth_checkToken(self, params):
+        return dict(
+            oauth=dict(
+                token=dict(_content="local"),
+                perms=dict(_content="write"),
+                user=dict(nsid=USER_ID, username=USERNAME, fullname=""),
+            )
+        )
+
+    # photos
+
+    def photos_search(self, params):
+        photos = list(self.library.photos.values())
+        filters = [
+            ("min_upload_date", "dateupload", int, lambda v, m: v >= m),
+            ("max_upload_date", "dateupload", int, lambda v, m: v <= m),
+            ("min_taken_date", "datetaken", str, lambda v, m: v >= m),
+            ("max_taken_date", "datetaken", str, lambda v, m: v <= m),
+        ]
+        for param, key, convert, predicate in filters:
+            if params.get(param):
+                value = convert(params[param])
+                photos = [p for p in photos if predicate(p[key], value)]
+
+        sort = params.get("sort", "date-posted-desc")
+        sort_key = "datetaken" if sort.startswith("date-taken") else "dateupload"
+        photos.sort(
+            key=lambda p: (p[sort_key], int(p["id"])), reverse=sort.endswith("desc")
+        )
+
+        paging, photos = _page(photos, params, self.config)
+        extras = params.get("extras", "")
+        return dict(photos=dict(**paging, photo=[_extras(p, extras) for p in photos]))
+
+    def photos_getInfo(self, params):
+        photo = self._photo(params["photo_id"])
+        return dict(
+            photo=dict(
+                id=photo["id"],
+                dateuploaded=str(photo["dateupload"]),
+                owner=dict(nsid=USER_ID, username=USERNAME, path_alias=USERNAME),
+                title=dict(_content=photo["title"]),
+                description=dict(_content=photo["description"]),
+                visibility=dict(ispublic=photo["ispublic"], isfriend=0, isfamily=0),
+                dates=dict(
+                    posted=str(photo["dateupload"]),
+                    taken=photo["datetaken"],
+                    lastupdate=str(photo["lastupdate"]),
+                ),
+                tags=dict(
+                    tag=[
+                        dict(
+                            id=tag_id,
+                            author=USER_ID,
+                            raw=raw,
+                            _content=_normalize_tag(raw),
+                        )
+                        for tag_id, raw in photo["tags"]
+                    ]
+                ),
+                location=dict(latitude=photo["latitude"], longitude=photo["longitude"]),
+            )
+        )
+
+    def photos_getExif(self, params):
+        photo = self._photo(params["photo_id"])
+        exif = [
+            dict(
+                tagspace="ExifIFD",
+                tag="DateTimeOriginal",
+                label="Date and Time (Original)",
+                raw=dict(_content=photo["datetaken"].replace("-", ":", 2)),
+            ),
+            dict(
+                tagspace="XMP-xmpMM",
+                tag="DocumentID",
+                label="Document ID",
+                raw=dict(_content=f"xmp.did:{photo['id']}"),
+            ),
+        ]
+        return dict(photo=dict(id=photo["id"], exif=exif))
+
+    def photos_setDates(self, params):
+        photo = self._photo(params["photo_id"])
+        if params.get("date_posted"):
+            photo["dateupload"] = int(params["date_posted"])
+        if params.get("date_taken"):
+            photo["datetaken"] = params["date_taken"]
+        return {}
+
+    def photos_setPerms(self, params):
+        photo = self._photo(params["photo_id"])
+        photo["ispublic"] = int(params.get("is_public", 0))
+        return {}
+
+    def photos_setMeta(self, params):
+        photo = self._photo(params["photo_id"])
+        if "title" in params:
+            photo["title"] = params["title"]
+        if "description" in params:
+            photo["description"] = params["description"]
+        return {}
+
+    def photos_addTags(self, params):
+        photo = self._photo(params["photo_id"])
+        existing = {raw for _, raw in photo["tags"]}
+        for tag in shlex.split(params.get("tags", "")):
+            if tag not in existing:
+                photo["tags"].append((str(next(self.library._tag_ids)), tag))
+                existing.add(tag)
+        return {}
+
+    def photos_removeTag(self, params):
+        for photo in self.library.photos.values():
+            tags = [t for t in photo["tags"] if t[0] != params["tag_id"]]
+            if len(tags) != len(photo["tags"]):
+                photo["tags"] = tags
+                return {}
+        raise MockFlickrError(1, "Tag not found")
+
+    def photos_geo_setLocation(self, params):
+        photo = self._photo(params["photo_id"])
+        photo["latitude"] = float(params["lat"])
+        photo["longitude"] = float(params["lon"])
+        return {}
+
+    def photos_upload_checkTickets(self, params):
+        now = time.monotonic()
+        tickets = []
+        for ticket_id in params["tickets"].split(","):
+            ticket = self.library.tickets.get(ticket_id)
+            if not ticket:
+                tickets.append(dict(id=ticket_id, invalid=1, complete=2))
+            elif now < ticket["ready_at"]:
+                tickets.append(dict(id=ticket_id, complete=0))
+            else:
+                tickets.append(
+                    dict(id=ticket_id, complete=1, photoid=ticket["photo_id"])
+                )
+        return dict(uploader=dict(ticket=tickets))
+
+    # photosets
+
+    def _album_data(self, album):
+        return dict(
+            id=album["id"],
+            primary=album["primary"],
+            photos=len(album["photo_ids"]),
+            videos=0,
+            count_photos=len(album["photo_ids"]),
+            count_videos=0,
+            title=dict(_content=album["title"]),
+            description=dict(_content=album["description"]),
+            date_create=str(album["date_create"]),
+            date_update=str(album["date_update"]),
+            owner=USER_ID,
+        )
+
+    def photosets_getList(self, params):
+        albums = [self._album_data(a) for a in self.library.albums.values()]
+        paging, albums = _page(albums, params, self.config)
+        return dict(photosets=dict(**paging, photoset=albums))
+
+    def photosets_getInfo(self, params):
+        album = self._album(params["photoset_id"])
+        return dict(photoset=self._album_data(album))
+
+    def photosets_getPhotos(self, params):
+        album = self._album(params["photoset_id"])
+        photos = [self.library.photos[i] for i in album["photo_ids"]]
+        paging, photos = _page(photos, params, self.config)
+        extras = params.get("extras", "")
+        photo_data = []
+        for photo in photos:
+            data = _extras(photo, extras)
+            data["isprimary"] = str(int(photo["id"] == album["primary"]))
+            photo_data.append(data)
+        return dict(
+            photoset=dict(
+                **paging,
+                per_page=paging["perpage"],
+                id=album["id"],
+                primary=album["primary"],
+                owner=USER_ID,
+                ownername=USERNAME,
+                title=album["title"],
+                photo=photo_data,
+            )
+        )
+
+    def photosets_create(self, params):
+        self._photo(params["primary_photo_id"])
+        album_id = self.library.add_album(
+            params.get("title", ""),
+            params["primary_photo_id"],
+            params.get("description", ""),
+        )
+        return dict(photoset=dict(id=album_id, url=f"http://localhost/{album_id}"))
+
+    def photosets_delete(self, params):
+        self._album(params["photoset_id"])
+        del self.library.albums[params["photoset_id"]]
+        return {}
+
+    def photosets_addPhoto(self, params):
+        album = self._album(params["photoset_id"])
+        photo_id = params["photo_id"]
+        self._photo(photo_id)
+        if photo_id in album["photo_ids"]:
+            raise MockFlickrError(3, "Photo already in set")
+        album["photo_ids"].append(photo_id)
+        self._touch(album)
+        return {}
+
+    def photosets_removePhotos(self, params):
+        album = self._album(params["photoset_id"])
+        to_remove = set(params["photo_ids"].split(","))
+        album["photo_ids"] = [i for i in album["photo_ids"] if i not in to_remove]
+        self._touch(album)
+        return {}
+
+    def photosets_editPhotos(self, params):
+        album = self._album(params["photoset_id"])
+        photo_ids = params["photo_ids"].split(",")
+        for photo_id in photo_ids:
+            self._photo(photo_id)
+        album["photo_ids"] = photo_ids
+        album["primary"] = params["primary_photo_id"]
+        self._touch(album)
+        return {}
+
+    def photosets_reorderPhotos(self, params):
+        album = self._album(params["photoset_id"])
+        ordered = params["photo_ids"].split(",")
+        in_order = set(ordered)
+        album["photo_ids"] = ordered + [
+            i for i in album["photo_ids"] if i not in in_order
+        ]
+        return {}
+
+    def photosets_orderSets(self, params):
+        ordered = [i for i in params["photoset_ids"].split(",") if i]
+        in_order = set(ordered)
+        albums = self.library.albums
+        rest = [i for i in albums if i not in in_order]
+        self.library.albums = {i: albums[i] for i in ordered + rest if i in albums}
+        return {}
+
+    # upload
+
+    def upload(self, params, photo_data):
+        self.library.calls["upload"] = self.library.calls.get("upload", 0) + 1
+        date_taken = read_date_taken(io.BytesIO(photo_data))
+        date_taken = to_flickr_date(date_taken) if date_taken else None
+        photo_id = self.library.add_photo(
+            params.get("title", ""),
+            shlex.split(params.get("tags", "")),
+            date_taken or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            is_public=params.get("is_public", 0),
+        )
+        if params.get("async") == "1":
+            ticket_id = self.library.next_id()
+            self.library.tickets[ticket_id] = dict(
+                photo_id=photo_id, ready_at=time.monotonic() + self.config.ticket_delay
+            )
+            return dict(ticketid=dict(_content=ticket_id))
+        return dict(photoid=dict(_content=photo_id))
+
+    def replace(self, params, photo_data):
+        self.library.calls["replace"] = self.library.calls.get("replace", 0) + 1
+        photo = self._photo(params["photo_id"])
+        photo["lastupdate"] = int(time.time())
+        if params.get("async") == "1":
+            ticket_id = self.library.next_id()
+            self.library.tickets[ticket_id] = dict(
+                photo_id=photo["id"],
+                ready_at=time.monotonic() + self.config.ticket_delay,
+            )
+            return dict(ticketid=dict(_content=ticket_id))
+        return dict(photoid=dict(_content=photo["id"]))
+
+
+def to_xml(data, stat="ok"):
+    """Flickr REST XML: scalars are attributes, _content is the text"""
+
+    def build(elem, value):
+        for key, child in value.items():
+            if key == "_content":
+                elem.text = str(child)
+            elif isinstance(child, dict):
+                build(ET.SubElement(elem, key), child)
+            elif isinstance(child, list):
+                for item in child:
+                    build(ET.SubElement(elem, key), item)
+            else:
+                elem.set(key, str(child))
+
+    rsp = ET.Element("rsp", stat=stat)
+    build(rsp, data)
+    return b'<?xml version="1.0" encoding="utf-8" ?>\n' + ET.tostring(rsp)
+
+
+class MockFlickrHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # set on the server
+    @property
+    def api(self) -> MockFlickrApi:
+        return self.server.api
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query), None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        content_type = self.headers.get("Content-Type", "")
+        config = self.api.config
+        if content_type.startswith("multipart/form-data"):
+            body = self._read_body(length, config.upload_bandwidth)
+            params, photo_data = _parse_multipart(content_type, body)
+        else:
+            body = self._read_body(length, 0)
+            params = parse_qs(body.decode("utf-8"), keep_blank_values=True)
+            photo_data = None
+        self._handle(params, photo_data)
+
+    def _read_body(self, length, bandwidth):
+        chunks = []
+        left = length
+        start = time.monotonic()
+        while left:
+            chunk = self.rfile.read(min(left, 64 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            left -= len(chunk)
+            if bandwidth:
+                # simulated uplink
+                expected = (length - left) / bandwidth
+                delay = expected - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        return b"".join(chunks)
+
+    def _handle(self, params, photo_data):
+        params = {k: v[0] if isinstance(v, list) else v for k, v in params.items()}
+        config = self.api.config
+        path = urlparse(self.path).path.rstrip("/")
+
+        if config.error_rate and random.random() < config.error_rate:
+            self._send(500, b"Internal error", "text/plain")
+            return
+
+        is_upload = path.endswith("/upload") or path.endswith("/replace")
+        try:
+            if path.endswith("/upload"):
+                with self.api.library.lock:
+                    data = self.api.upload(params, photo_data)
+            elif path.endswith("/replace"):
+                with self.api.library.lock:
+                    data = self.api.replace(params, photo_data)
+            else:
+                if config.latency:
+                    time.sleep(config.latency)
+                data = self.api.call(params.get("method", ""), params)
+        except MockFlickrError as ex:
+            error = dict(code=ex.code, message=ex.message)
+            if is_upload or params.get("format") == "rest":
+                self._send(
+                    200, to_xml(dict(err=dict(code=ex.code, msg=ex.message)), "fail")
+                )
+            else:
+                self._send(200, json.dumps(dict(stat="fail", **error)).encode())
+            return
+
+        if is_upload or params.get("format") == "rest":
+            self._send(200, to_xml(data))
+        else:
+            self._send(200, json.dumps(dict(**data, stat="ok")).encode())
+
+    def _send(self, status, body, content_type=None):
+        if content_type is None:
+            is_xml = body.startswith(b"<?xml")
+            content_type = "text/xml" if is_xml else "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _parse_multipart(content_type, body):
+    message = BytesParser().parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    params = {}
+    photo_data = None
+    for part in message.get_payload():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True)
+        if name == "photo":
+            photo_data = payload
+        else:
+            params[name] = payload.decode("utf-8")
+    return params, photo_data
+
+
+class MockFlickrServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, library: MockLibrary):
+        super().__init__(address, MockFlickrHandler)
+        self.api = MockFlickrApi(library)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start_in_thread(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8765)
+@click.option("--latency", default=0.0, help="Seconds added to each REST call")
+@click.option("--upload-bandwidth", default=0, help="Upload bytes/s (0: no limit)")
+@click.option(
+    "--ticket-delay", default=0.0, help="Seconds before an upload ticket is complete"
+)
+@click.option("--max-per-page", default=MAX_PER_PAGE, help="Max items per page")
+@click.option("--error-rate", default=0.0, help="Probability of an HTTP 500 error")
+@click.option("--photos", "num_photos", default=0, help="Photos created at start")
+@click.option("--albums", "num_albums", default=0, help="Albums created at start")
+def main(
+    host,
+    port,
+    latency,
+    upload_bandwidth,
+    ticket_delay,
+    max_per_page,
+    error_rate,
+    num_photos,
+    num_albums,
+):
+    """Run the mock Flickr API server."""
+    logging.basicConfig(level=logging.INFO)
+    config = MockConfig(
+        latency, upload_bandwidth, ticket_delay, max_per_page, error_rate
+    )
+    library = MockLibrary(config)
+    library.populate(num_photos, num_albums)
+    server = MockFlickrServer((host, port), library)
+    logger.info(f"Mock Flickr API on {server.url} (FAU_API_URL={server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
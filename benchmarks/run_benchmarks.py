@@ -0,0 +1,210 @@
+"""End-to-end benchmarks of flickr_api_utils commands against the mock Flickr API
+
+Each command is run as a subprocess (like a user would) pointed at an in-process mock
+server through FAU_API_URL. Throughput is reported for each command:
+
+    python -m benchmarks.run_benchmarks --photos 40 --upload-bandwidth 20000000
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+from PIL import Image
+
+from flickr_api_utils.api_auth import API_URL_ENVVAR
+
+from .mock_flickr import MockConfig, MockFlickrServer, MockLibrary
+
+logger = logging.getLogger(__name__)
+
+ALBUM_NAME = "Benchmark"
+
+XMP_TEMPLATE = """<x:xmpmeta xmlns:x="adobe:ns:meta/">
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about=""
+ xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+ xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/"
+ xmlns:dc="http://purl.org/dc/elements/1.1/"
+ xmp:Label="Accepted"
+ xmpMM:DocumentID="xmp.did:{did}">
+<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{title}</rdf:li></rdf:Alt></dc:title>
+<dc:subject><rdf:Bag><rdf:li>benchmark</rdf:li><rdf:li>{tag}</rdf:li></rdf:Bag>
+</dc:subject>
+</rdf:Description>
+</rdf:RDF>
+</x:xmpmeta>"""
+
+# EXIF tag
+DATE_TIME_ORIGINAL = 0x9003
+EXIF_IFD = 0x8769
+
+
+def generate_photos(folder, num_photos, image_size, seed=0):
+    """JPEG files with EXIF date taken and XMP metadata like the exported files"""
+    rnd = random.Random(seed)
+    start = datetime(2024, 6, 1, 8, 0, 0)
+    total_size = 0
+    for i in range(num_photos):
+        # noise so the JPEG size is realistic
+        im = Image.frombytes(
+            "RGB", image_size, rnd.randbytes(3 * image_size[0] * image_size[1])
+        )
+        exif = Image.Exif()
+        date_taken = start + timedelta(minutes=i)
+        exif.get_ifd(EXIF_IFD)[DATE_TIME_ORIGINAL] = date_taken.strftime(
+            "%Y:%m:%d %H:%M:%S"
+        )
+        xmp = XMP_TEMPLATE.format(
+            did=f"{seed}-{i}", title=f"Bench {i}", tag=f"t{i % 7}"
+        )
+        filepath = os.path.join(folder, f"P{i:05d}.JPG")
+        im.save(filepath, quality=90, exif=exif, xmp=xmp.encode("utf-8"))
+        total_size += os.path.getsize(filepath)
+    return total_size
+
+
+def run_command(server_url, cwd, *args):
+    env = dict(os.environ, **{API_URL_ENVVAR: server_url})
+    # package importable from the benchmark working directory
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    start = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, "-m", "flickr_api_utils", *args],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.monotonic() - start
+    if result.returncode != 0:
+        raise click.ClickException(
+            f"{' '.join(args)} failed:\n{result.stdout}\n{result.stderr}"
+        )
+    return elapsed
+
+
+def _album_id(library, title):
+    for album in library.albums.values():
+        if album["title"] == title:
+            return album["id"]
+    return None
+
+
+@click.command()
+@click.option("--photos", "num_photos", default=20, help="Photos to upload")
+@click.option(
+    "--image-size", default="2000x1500", help="Size of the generated photos (WxH)"
+)
+@click.option("--albums", "num_albums", default=200, help="Albums for album reorder")
+@click.option("--library-photos", default=5000, help="Photos in the library at start")
+@click.option("--parallel", default=None, type=int, help="--parallel for upload")
+@click.option("--latency", default=0.05, help="Seconds added to each REST call")
+@click.option("--upload-bandwidth", default=0, help="Upload bytes/s (0: no limit)")
+@click.option(
+    "--ticket-delay", default=1.0, help="Seconds before an upload ticket is complete"
+)
+@click.option("--json-out", type=click.Path(dir_okay=False), help="Save the results")
+def main(
+    num_photos,
+    image_size,
+    num_albums,
+    library_photos,
+    parallel,
+    latency,
+    upload_bandwidth,
+    ticket_delay,
+    json_out,
+):
+    """Benchmark upload standard, photo find-replace and album reorder."""
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    width, height = map(int, image_size.lower().split("x"))
+
+    config = MockConfig(
+        latency=latency, upload_bandwidth=upload_bandwidth, ticket_delay=ticket_delay
+    )
+    library = MockLibrary(config)
+    library.populate(library_photos, num_albums)
+    server = MockFlickrServer(("127.0.0.1", 0), library)
+    server.start_in_thread()
+
+    results = []
+
+    def report(name, elapsed, count, unit, num_bytes=None):
+        result = dict(
+            command=name,
+            seconds=round(elapsed, 3),
+            count=count,
+            unit=unit,
+            per_second=round(count / elapsed, 2),
+        )
+        line = f"{name:<30} {elapsed:8.2f} s {count / elapsed:10.2f} {unit}/s"
+        if num_bytes is not None:
+            result["mb_per_second"] = round(num_bytes / elapsed / 1e6, 2)
+            line += f" {result['mb_per_second']:8.2f} MB/s"
+        results.append(result)
+        logger.info(line)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        folder = os.path.join(work_dir, "photos")
+        os.makedirs(folder)
+        logger.info(f"Generating {num_photos} photos {width}x{height}...")
+        total_size = generate_photos(folder, num_photos, (width, height))
+
+        upload_args = [
+            "upload",
+            "standard",
+            "--folder",
+            folder,
+            "--yes",
+            "--create-album",
+            "--album-name",
+            ALBUM_NAME,
+        ]
+        if parallel:
+            upload_args += ["--parallel", str(parallel)]
+        elapsed = run_command(server.url, work_dir, *upload_args)
+        report("upload standard", elapsed, num_photos, "photos", total_size)
+
+        album_id = _album_id(library, ALBUM_NAME)
+        elapsed = run_command(
+            server.url,
+            work_dir,
+            "photo",
+            "find-replace",
+            "--album",
+            album_id,
+            "--find-title",
+            "Bench",
+            "--replace-title",
+            "Renamed",
+        )
+        report("photo find-replace", elapsed, num_photos, "photos")
+
+        num_albums = len(library.albums)
+        elapsed = run_command(server.url, work_dir, "album", "reorder")
+        report("album reorder", elapsed, num_albums, "albums")
+        # album dates cached by the first run
+        elapsed = run_command(server.url, work_dir, "album", "reorder")
+        report("album reorder (cached)", elapsed, num_albums, "albums")
+
+    calls = sorted(library.calls.items(), key=lambda x: -x[1])
+    logger.info("API calls: " + ", ".join(f"{m} {n}" for m, n in calls))
+
+    if json_out:
+        with open(json_out, "w", encoding="utf-8") as f:
+            json.dump(dict(results=results, api_calls=dict(calls)), f, indent=2)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
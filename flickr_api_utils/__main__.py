@@ -1,3 +1,4 @@
+from functools import partial
 import logging
 import os
 import sys
@@ -5,7 +6,10 @@ import sys
 import click
 import coloredlogs
 
+from . import bandwidth, metrics, profiler, trace
 from .album import album
+from .base import COMMAND_PATH_META
+from .library import library
 from .local import local
 from .photo import photo
 from .upload import upload
@@ -29,15 +33,81 @@ def setup_logging(logger):
 
 @click.group(context_settings={"show_default": True})
 @click.version_option()
-def cli():
+@click.option(
+    "--metrics-out",
+    type=click.Path(dir_okay=False),
+    help="Write a JSON summary of the Flickr API calls (count, latency percentiles, "
+    "retries), bytes transferred and stage timings",
+)
+@click.option(
+    "--profile",
+    "profile_out",
+    type=click.Path(dir_okay=False),
+    help="Profile the command (sampling, including the pool workers) and write the "
+    "stacks in the folded format for flamegraph.pl / speedscope",
+)
+@click.option(
+    "--trace-out",
+    type=click.Path(dir_okay=False),
+    help="Write the API calls, uploads, retries and stages as Chrome trace events "
+    "(one lane per process and thread) for chrome://tracing or Perfetto",
+)
+@click.option(
+    "--bwlimit",
+    callback=lambda ctx, param, value: _parse(bandwidth.parse_rate, param, value),
+    help="Max bytes/s for all the uploads and downloads together (like 500K, 2M)",
+    envvar="FAU_BWLIMIT",
+)
+@click.option(
+    "--bwlimit-schedule",
+    callback=lambda ctx, param, value: _parse(bandwidth.parse_schedule, param, value),
+    help="Max bytes/s by time of day, overriding --bwlimit in the periods (like "
+    "08:00-19:00=1M,19:00-08:00=off)",
+    envvar="FAU_BWLIMIT_SCHEDULE",
+)
+@click.pass_context
+def cli(ctx, metrics_out, profile_out, trace_out, bwlimit, bwlimit_schedule):
     logger = logging.getLogger(__package__)
     setup_logging(logger)
 
+    if metrics_out:
+        metrics.enable()
+        # after the subcommand, even if it failed
+        ctx.call_on_close(partial(_write_metrics, ctx, metrics_out))
+
+    if profile_out:
+        profiler.enable()
+        ctx.call_on_close(partial(profiler.write_report, profile_out))
+
+    if trace_out:
+        trace.enable()
+        ctx.call_on_close(partial(trace.write_report, trace_out))
+
+    if bwlimit or bwlimit_schedule:
+        bandwidth.enable(bwlimit or 0, bwlimit_schedule)
+
+
+def _write_metrics(ctx, path):
+    # full subcommand path recorded by the leaf command, or only the group if it
+    # failed before (like a usage error)
+    command = ctx.meta.get(COMMAND_PATH_META, ctx.invoked_subcommand)
+    metrics.write_report(path, command)
+
+
+def _parse(func, param, value):
+    if value is None:
+        return None
+    try:
+        return func(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param=param) from ex
+
 
 cli.add_command(photo)
 cli.add_command(album)
 cli.add_command(local)
 cli.add_command(upload)
+cli.add_command(library)
 
 if __name__ == "__main__":
     try:
@@ -1,17 +1,19 @@
-from collections import defaultdict, namedtuple
 from datetime import UTC, datetime
+import heapq
 import json
 import logging
+import operator
 from operator import attrgetter
 import os.path
+import re
 
 from addict import Dict as Addict
 import click
-import dateutil.parser
 
+from .album_order import AlbumOrderStore, get_album_dates, reapply_order
 from .api_auth import auth_flickr
 from .base import CatchAllExceptionsCommand
-from .flickr_utils import get_photos
+from .flickr_utils import all_pages, get_photos, reorder_by_date_taken
 from .url_utils import extract_album_id, extract_photo_id
 
 logger = logging.getLogger(__name__)
@@ -23,20 +25,6 @@ def album():
     pass
 
 
-def all_pages(page_elem, iter_elem, func, *args, **kwargs):
-    """Helper to iterate through all pages of a Flickr API result."""
-    page = 1
-    acc = []
-    while True:
-        paginated = Addict(func(*args, **kwargs, page=page))[page_elem]
-        acc.extend(paginated[iter_elem])
-
-        if int(paginated.page) >= int(paginated.pages):
-            return acc
-
-        page += 1
-
-
 def get_albums():
     """Get all albums for the authenticated user."""
     flickr = auth_flickr()
@@ -95,26 +83,28 @@ def delete_album(album, yes):
 
 @album.command("move-to-top", cls=CatchAllExceptionsCommand)
 @click.argument("album")
-@click.option(
-    "--save-original",
-    default="original_set_to_top.txt",
-    help="File to save original order to",
-)
-def move_to_top(album, save_original):
+def move_to_top(album):
     """Move an album to the top of your album list.
 
-    ALBUM can be an album ID or URL.
+    ALBUM can be an album ID or URL. The previous order is saved (see undo-order).
     """
     flickr = auth_flickr()
     album_id = extract_album_id(album)
+    store = AlbumOrderStore()
 
     albums = list(get_albums())
     album_ids = list(map(attrgetter("id"), albums))
 
-    # Save original order
-    if not os.path.exists(save_original):
-        with open(save_original, "w") as f:
-            f.write(repr(album_ids))
+    if not album_ids:
+        logger.warning("No albums found")
+        return
+
+    if album_ids[0] == album_id:
+        logger.info(f"Album {album_id} already at the top")
+        return
+
+    version = store.save_snapshot(album_ids, f"move-to-top {album_id}")
+    logger.info(f"Original order saved (version {version})")
 
     album_ids.pop(album_ids.index(album_id))
     album_ids.insert(0, album_id)
@@ -130,17 +120,15 @@ def move_to_top(album, save_original):
     "--start-album",
     help="Album ID or URL to start reordering from (inclusive)",
 )
-@click.option(
-    "--save-original",
-    default="original_set_to_top.txt",
-    help="File to save original order to",
-)
-def reorder_albums(start_album, save_original):
+def reorder_albums(start_album):
     """Reorder albums by the modal date of photos in each album.
 
-    The most common date taken in an album is used to determine its position.
+    The most common date taken in an album is used to determine its position. The
+    dates are cached locally: only the albums modified since the last run are listed.
+    The previous order is saved (see undo-order).
     """
     flickr = auth_flickr()
+    store = AlbumOrderStore()
 
     if start_album:
         start_album_id = extract_album_id(start_album)
@@ -148,44 +136,16 @@ def reorder_albums(start_album, save_original):
         start_album_id = None
 
     albums = list(get_albums())
-
-    # Save original order
-    if not os.path.exists(save_original):
-        with open(save_original, "w") as f:
-            f.write(repr(list(map(attrgetter("id"), albums))))
+    original_album_ids = list(map(attrgetter("id"), albums))
 
     as_is = []
     if start_album_id:
-        until_index = list(map(attrgetter("id"), albums)).index(start_album_id) + 1
+        until_index = original_album_ids.index(start_album_id) + 1
         until = albums[:until_index]
         as_is = albums[until_index:]
         albums = until
 
-    DatePercent = namedtuple("DatePercent", "date percent")
-    album_dates = {}
-
-    for album_data in albums:
-        logger.info(f"{album_data.title._content} {album_data.id}")
-        album_id = album_data.id
-        photos = all_pages(
-            "photoset",
-            "photo",
-            flickr.photosets.getPhotos,
-            photoset_id=album_id,
-            extras="date_taken,url_o",
-        )
-        date_counts = defaultdict(lambda: 0)
-        for photo in photos:
-            date = dateutil.parser.isoparse(photo.datetaken).date()
-            date_iso = date.isoformat()
-            date_counts[date_iso] += 1
-
-        date_mode = max(date_counts, key=lambda x: date_counts[x])
-        date_mode_count = date_counts[date_mode]
-        all_counts = len(photos)
-        percent_mode = date_mode_count / all_counts
-
-        album_dates[album_id] = DatePercent(date_mode, percent_mode)
+    album_dates = get_album_dates(flickr, albums, store)
 
     partial_ordered_album_ids = list(
         sorted(album_dates.keys(), key=lambda x: album_dates[x].date, reverse=True)
@@ -193,12 +153,70 @@ def reorder_albums(start_album, save_original):
 
     ordered_album_ids = partial_ordered_album_ids + list(map(attrgetter("id"), as_is))
 
+    if ordered_album_ids == original_album_ids:
+        logger.info("Albums already in order")
+        return
+
+    version = store.save_snapshot(original_album_ids, "reorder")
+    logger.info(f"Original order saved (version {version})")
+
     logger.info("Reordering albums...")
     q_album_ids = ",".join(ordered_album_ids)
     flickr.photosets.orderSets(photoset_ids=q_album_ids)
     logger.info("Albums reordered")
 
 
+@album.command("order-history", cls=CatchAllExceptionsCommand)
+def order_history():
+    """List the saved album orders (before move-to-top / reorder)."""
+    snapshots = AlbumOrderStore().list_snapshots()
+    if not snapshots:
+        logger.info("No saved album order")
+        return
+
+    for snapshot in snapshots:
+        logger.info(
+            f"{snapshot.version:5d} {snapshot.created} {snapshot.reason} "
+            f"({len(snapshot.album_ids)} albums)"
+        )
+
+
+@album.command("undo-order", cls=CatchAllExceptionsCommand)
+@click.option(
+    "--version",
+    "version",
+    type=int,
+    help="Version of the saved order to reapply (default: latest)",
+)
+@click.option("--yes", is_flag=True, help="Skip confirmation")
+def undo_order(version, yes):
+    """Reapply a saved album order.
+
+    Albums created after the order was saved are kept at the top.
+    """
+    flickr = auth_flickr()
+    store = AlbumOrderStore()
+
+    snapshot = store.load_snapshot(version)
+    if not snapshot:
+        raise click.ClickException("No saved album order")
+
+    current_ids = list(map(attrgetter("id"), get_albums()))
+    ordered_album_ids = reapply_order(current_ids, snapshot.album_ids)
+    if ordered_album_ids == current_ids:
+        logger.info("Albums already in that order")
+        return
+
+    if not yes:
+        description = f"{snapshot.created}, {snapshot.reason}"
+        if not click.confirm(f"Reapply order {snapshot.version} ({description})?"):
+            logger.warning("Aborted")
+            return
+
+    flickr.photosets.orderSets(photoset_ids=",".join(ordered_album_ids))
+    logger.info(f"Album order {snapshot.version} reapplied")
+
+
 @album.command("reorder-photos", cls=CatchAllExceptionsCommand)
 @click.argument("album")
 def reorder_photos(album):
@@ -209,13 +227,11 @@ def reorder_photos(album):
     flickr = auth_flickr()
     album_id = extract_album_id(album)
 
-    photos = get_photos(flickr, album_id)
-    photos = sorted(photos, key=attrgetter("datetaken"))
-    photo_ids = list(map(attrgetter("id"), photos))
-
-    q_photo_ids = ",".join(photo_ids)
-    flickr.photosets.reorderPhotos(photoset_id=album_id, photo_ids=q_photo_ids)
-    logger.info(f"Reordered photos in album {album_id}")
+    photos = get_photos(flickr, album_id, extras="date_taken")
+    if reorder_by_date_taken(flickr, album_id, photos):
+        logger.info(f"Reordered photos in album {album_id}")
+    else:
+        logger.info(f"Photos in album {album_id} already in order")
 
 
 @album.command("remove-photos", cls=CatchAllExceptionsCommand)
@@ -277,6 +293,29 @@ def remove_photos(album, start_photo, end_photo, yes):
     logger.info(f"Removed {len(photo_ids)} photos from album {album_id}")
 
 
+NUMERIC_ALBUM_ATTRS = {
+    "count_views",
+    "count_comments",
+    "count_photos",
+    "count_videos",
+    "photos",
+    "videos",
+    "date_create",
+    "date_update",
+}
+
+FILTER_REGEX = re.compile(r"^\s*([\w.]+)\s*(>=|<=|!=|=|>|<|~)\s*(.*?)\s*$")
+FILTER_OPS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "!=": operator.ne,
+    "=": operator.eq,
+    ">": operator.gt,
+    "<": operator.lt,
+    "~": lambda value, pattern: pattern.search(str(value)) is not None,
+}
+
+
 @album.command("info", cls=CatchAllExceptionsCommand)
 @click.option(
     "--start-album",
@@ -285,7 +324,10 @@ def remove_photos(album, start_photo, end_photo, yes):
 @click.option(
     "--sort-by",
     default="count_views",
-    help="Attribute to sort by (e.g., 'count_views', 'count_photos')",
+    help=(
+        "Comma-separated attributes to sort by (e.g., 'count_views', "
+        "'-count_photos,title'). Prefix with - or + to override --order for a key"
+    ),
 )
 @click.option(
     "--order",
@@ -293,6 +335,31 @@ def remove_photos(album, start_photo, end_photo, yes):
     default="desc",
     help="Sort order",
 )
+@click.option(
+    "--filter",
+    "filters",
+    multiple=True,
+    help=(
+        "Filter expression: attribute, operator (=, !=, <, <=, >, >=, ~ for regex) "
+        "and value (e.g., 'count_photos>=50'). Can be repeated (all must match)"
+    ),
+)
+@click.option(
+    "--top",
+    type=click.IntRange(min=1),
+    help="Only show the first N albums",
+)
+@click.option(
+    "--page",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Page of results to show (with --page-size)",
+)
+@click.option(
+    "--page-size",
+    type=click.IntRange(min=1),
+    help="Number of albums per page",
+)
 @click.option(
     "--save-file",
     default="albums.json",
@@ -308,43 +375,31 @@ def remove_photos(album, start_photo, end_photo, yes):
     default="title._content,id,count_views,count_photos",
     help="Comma-separated list of attributes to display",
 )
-def info(start_album, sort_by, order, save_file, load_from_file, show_attrs):
-    """Display album information sorted by various attributes."""
-    import functools
-
+def info(
+    start_album,
+    sort_by,
+    order,
+    filters,
+    top,
+    page,
+    page_size,
+    save_file,
+    load_from_file,
+    show_attrs,
+):
+    """Display album information sorted by various attributes.
+
+    With --load-from-file, the query runs on the cached album list without any API
+    call.
+    """
     if start_album:
         start_album_id = extract_album_id(start_album)
     else:
         start_album_id = None
 
     show_attrs = show_attrs.split(",")
-
-    def sub_attr(attr: str):
-        if "." in attr:
-            attr = attr.split(".")
-        else:
-            attr = [attr]
-
-        def wrapper(album_data):
-            sub_value = album_data
-            for attr_part in attr:
-                sub_value = sub_value[attr_part]
-            return sub_value
-
-        return wrapper
-
-    def convert_attr(attr):
-        try:
-            return int(attr)
-        except (ValueError, TypeError):
-            return attr
-
-    def chain(*fs, reverse=True):
-        def wrapper(arg):
-            functions = reversed(fs) if reverse else fs
-            return functools.reduce(lambda m, f: f(m), functions, arg)
-
-        return wrapper
+    sort_keys = _parse_sort_keys(sort_by, order == "desc")
+    filters = [_parse_filter(f) for f in filters]
 
     if load_from_file and os.path.exists(save_file):
         with open(save_file, encoding="utf-8") as f:
@@ -364,15 +419,115 @@ def info(start_album, sort_by, order, save_file, load_from_file, show_attrs):
     else:
         albums_sub = albums
 
-    key = chain(convert_attr, sub_attr(sort_by))
+    # index: values of the attributes used in the query, resolved and converted once
+    # per album
+    attrs = {attr for attr, _ in sort_keys} | {attr for attr, _, _ in filters}
+    attrs.update(show_attrs)
+    rows = [_album_values(album_data, attrs) for album_data in albums_sub]
+
+    for attr, op, value in filters:
+        rows = [row for row in rows if _match(row[attr], op, value)]
+
+    def key(row):
+        return tuple(_sort_value(row[attr], desc) for attr, desc in sort_keys)
+
+    if top:
+        # heap selection: no need to sort everything
+        rows = heapq.nsmallest(top, rows, key=key)
+    else:
+        rows = sorted(rows, key=key)
+
+    if page_size:
+        start = (page - 1) * page_size
+        logger.info(
+            f"Page {page}/{max(1, -(-len(rows) // page_size))} ({len(rows)} albums)"
+        )
+        rows = rows[start : start + page_size]
+
+    for row in rows:
+        logger.info("\t".join(str(row[attr]) for attr in show_attrs))
+
+
+def _parse_sort_keys(sort_by, is_desc_default):
+    sort_keys = []
+    for attr in sort_by.split(","):
+        attr = attr.strip()
+        if not attr:
+            # trailing comma
+            continue
+        desc = is_desc_default
+        if attr[0] in "+-":
+            desc = attr[0] == "-"
+            attr = attr[1:].strip()
+        if not attr:
+            raise click.BadParameter(f"Missing attribute in sort: {sort_by}")
+        sort_keys.append((attr, desc))
+    return sort_keys
+
+
+def _parse_filter(filter_expr):
+    m = FILTER_REGEX.match(filter_expr)
+    if not m:
+        raise click.BadParameter(f"Invalid filter: {filter_expr}")
+    attr, op, value = m.groups()
+    if op == "~":
+        try:
+            value = re.compile(value)
+        except re.error as ex:
+            raise click.BadParameter(
+                f"Invalid regex in filter {filter_expr}: {ex}"
+            ) from ex
+    elif attr in NUMERIC_ALBUM_ATTRS:
+        value = _convert_attr(value)
+    return attr, FILTER_OPS[op], value
+
+
+def _album_values(album_data, attrs):
+    values = {}
+    for attr in attrs:
+        value = album_data
+        for attr_part in attr.split("."):
+            value = value.get(attr_part) if isinstance(value, dict) else None
+        if attr in NUMERIC_ALBUM_ATTRS:
+            value = _convert_attr(value)
+        values[attr] = value
+    return values
+
+
+def _convert_attr(attr):
+    try:
+        return int(attr)
+    except (ValueError, TypeError):
+        return attr
+
+
+def _match(value, op, filter_value):
+    try:
+        return value is not None and op(value, filter_value)
+    except TypeError:
+        # not comparable (eg not a number)
+        return False
+
+
+class _Desc:
+    """Reverses the comparison of a value (desc order for any type in a sort key)"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
 
-    reverse = order == "desc"
-    albums_sub = sorted(albums_sub, key=key, reverse=reverse)
 
-    show_attrs_f = [sub_attr(attr) for attr in show_attrs]
-    for album_data in albums_sub:
-        album_str = []
-        for attr_f in show_attrs_f:
-            value = str(attr_f(album_data))
-            album_str.append(value)
-        logger.info("\t".join(album_str))
+def _sort_value(value, desc):
+    # missing values always at the end
+    if value is None:
+        return (1, None)
+    if desc:
+        value = -value if isinstance(value, int) else _Desc(value)
+    return (0, value)
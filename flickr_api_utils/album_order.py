@@ -0,0 +1,139 @@
+from collections import Counter, namedtuple
+from datetime import datetime
+import json
+import logging
+import os
+
+from .flickr_utils import get_photos
+
+logger = logging.getLogger(__name__)
+
+# in the current directory like the token cache
+ALBUM_ORDER_DIR = ".album_order"
+SNAPSHOTS_DIR = "snapshots"
+DATE_STATS_FILE = "album_dates.json"
+
+DatePercent = namedtuple("DatePercent", "date percent")
+Snapshot = namedtuple("Snapshot", "version created reason album_ids")
+
+
+class AlbumOrderStore:
+    """Local store for the album ordering
+
+    - snapshots of the album order (versioned: one file per version) so a reorder can
+    be undone
+    - date statistics of each album (modal date taken) with the album date_update and
+    counts they were computed from, so only changed albums are listed again
+    """
+
+    def __init__(self, folder=ALBUM_ORDER_DIR):
+        self.folder = folder
+        self.snapshots_folder = os.path.join(folder, SNAPSHOTS_DIR)
+        self.date_stats_path = os.path.join(folder, DATE_STATS_FILE)
+
+    def save_snapshot(self, album_ids, reason):
+        os.makedirs(self.snapshots_folder, exist_ok=True)
+        versions = self._versions()
+        version = versions[-1] + 1 if versions else 1
+        snapshot = Snapshot(version, datetime.now().isoformat(), reason, album_ids)
+        with open(self._snapshot_path(version), "w", encoding="utf-8") as f:
+            json.dump(snapshot._asdict(), f)
+        return version
+
+    def load_snapshot(self, version=None):
+        """Snapshot with the version (latest if None)"""
+        if version is None:
+            versions = self._versions()
+            if not versions:
+                return None
+            version = versions[-1]
+        path = self._snapshot_path(version)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return Snapshot(**json.load(f))
+
+    def list_snapshots(self):
+        return [self.load_snapshot(version) for version in self._versions()]
+
+    def _versions(self):
+        if not os.path.isdir(self.snapshots_folder):
+            return []
+        return sorted(
+            int(os.path.splitext(name)[0])
+            for name in os.listdir(self.snapshots_folder)
+            if name.endswith(".json")
+        )
+
+    def _snapshot_path(self, version):
+        return os.path.join(self.snapshots_folder, f"{version:05d}.json")
+
+    def load_date_stats(self):
+        if not os.path.exists(self.date_stats_path):
+            return {}
+        with open(self.date_stats_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_date_stats(self, date_stats):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.date_stats_path, "w", encoding="utf-8") as f:
+            json.dump(date_stats, f)
+
+
+def _album_version(album_data):
+    # changes when photos are added or removed
+    return [
+        str(album_data.date_update),
+        str(album_data.count_photos),
+        str(album_data.count_videos),
+    ]
+
+
+def get_album_dates(flickr, albums, store: AlbumOrderStore):
+    """Modal date taken of each album: DatePercent by album ID
+
+    Only the albums changed since the last call are listed.
+    """
+    date_stats = store.load_date_stats()
+    album_dates = {}
+    num_listed = 0
+    try:
+        for album_data in albums:
+            album_id = album_data.id
+            version = _album_version(album_data)
+            cached = date_stats.get(album_id)
+            if not cached or cached["version"] != version:
+                logger.info(f"{album_data.title._content} {album_id}")
+                photos = get_photos(flickr, album_id, extras="date_taken")
+                cached = dict(version=version, **compute_date_mode(photos)._asdict())
+                date_stats[album_id] = cached
+                num_listed += 1
+            album_dates[album_id] = DatePercent(cached["date"], cached["percent"])
+    finally:
+        # keep what was computed even if interrupted
+        if num_listed:
+            store.save_date_stats(date_stats)
+
+    logger.info(f"{num_listed} albums listed ({len(album_dates)} albums)")
+    return album_dates
+
+
+def compute_date_mode(photos):
+    # date only : first 10 characters of the Flickr date taken
+    date_counts = Counter(photo.datetaken[:10] for photo in photos)
+    if not date_counts:
+        return DatePercent("", 0)
+    date_mode, date_mode_count = date_counts.most_common(1)[0]
+    return DatePercent(date_mode, date_mode_count / len(photos))
+
+
+def reapply_order(current_ids, snapshot_ids):
+    """Order of the snapshot for the current albums
+
+    Albums created after the snapshot stay at the top (in their current order),
+    deleted albums are ignored.
+    """
+    current = set(current_ids)
+    in_snapshot = set(snapshot_ids)
+    new_ids = [album_id for album_id in current_ids if album_id not in in_snapshot]
+    return new_ids + [album_id for album_id in snapshot_ids if album_id in current]
@@ -1,10 +1,55 @@
 import json
+import os
 from pathlib import Path
 import random
 import string
 
 from addict import Dict as Addict
 import flickrapi
+from flickrapi.auth import FlickrAccessToken, OAuthFlickrInterface
+import requests
+
+from .metrics import metrics
+from .worker_pool import register_worker_setup
+
+# base URL of a local Flickr API stand-in (see benchmarks/mock_flickr.py) used instead
+# of api.flickr.com / up.flickr.com
+API_URL_ENVVAR = "FAU_API_URL"
+
+
+class InstrumentedFlickrAPI(flickrapi.FlickrAPI):
+    """FlickrAPI with the calls and uploaded bytes recorded in the metrics"""
+
+    def do_flickr_call(self, _method_name, timeout=None, **kwargs):
+        with metrics.api_call(_method_name):
+            return super().do_flickr_call(_method_name, timeout=timeout, **kwargs)
+
+    def _upload_to_form(self, form_url, filename, fileobj=None, timeout=None, **kwargs):
+        method = "replace" if form_url == self.REPLACE_URL else "upload"
+        with metrics.api_call(method):
+            resp = super()._upload_to_form(
+                form_url, filename, fileobj, timeout=timeout, **kwargs
+            )
+        # transcoded photo: smaller than the file
+        size = len(fileobj) if fileobj is not None else os.path.getsize(filename)
+        metrics.add_bytes("upload", size)
+        return resp
+
+
+def reset_connections():
+    """New HTTP connections for flickrapi in a pool worker
+
+    The requests session is a class attribute of flickrapi: a forked worker would
+    share the keep-alive connections opened by the main process with the other workers
+    (responses mixed up, seen as connection aborted).
+    """
+    session = requests.Session()
+    # User-Agent set in auth_flickr
+    session.headers = OAuthFlickrInterface.session.headers
+    OAuthFlickrInterface.session = session
+
+
+register_worker_setup(reset_connections)
 
 
 def generate_random_string(length):
@@ -13,14 +58,18 @@ def generate_random_string(length):
     return result_str
 
 
-def auth_flickr() -> flickrapi.FlickrAPI:
+def auth_flickr() -> InstrumentedFlickrAPI:
+    api_url = os.getenv(API_URL_ENVVAR)
+    if api_url:
+        return _local_flickr(api_url)
+
     with open("api_key.json") as f:
         flickr_key = Addict(json.load(f))
 
     api_key = flickr_key.key
     api_secret = flickr_key.secret
 
-    flickr = flickrapi.FlickrAPI(
+    flickr = InstrumentedFlickrAPI(
         api_key,
         api_secret,
         format="parsed-json",
@@ -39,3 +88,16 @@ def auth_flickr() -> flickrapi.FlickrAPI:
         flickr.authenticate_via_browser(perms="write")
 
     return flickr
+
+
+def _local_flickr(api_url) -> InstrumentedFlickrAPI:
+    # no key or token needed and the real token cache is not touched
+    flickr = InstrumentedFlickrAPI(
+        "local", "local", format="parsed-json", store_token=False
+    )
+    flickr.token_cache.token = FlickrAccessToken("local", "local", "write")
+    api_url = api_url.rstrip("/")
+    flickr.REST_URL = f"{api_url}/services/rest/"
+    flickr.UPLOAD_URL = f"{api_url}/services/upload/"
+    flickr.REPLACE_URL = f"{api_url}/services/replace/"
+    return flickr
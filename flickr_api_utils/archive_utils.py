@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import filecmp
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+COPY_CONCURRENCY = 4
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def is_same_device(path, other_path):
+    return os.stat(path).st_dev == os.stat(other_path).st_dev
+
+
+def move_tree(src, dst_dir, parallel=COPY_CONCURRENCY):
+    """Move the folder src inside dst_dir.
+
+    Same filesystem: a single atomic rename. Otherwise: parallel copy of the files,
+    compared with the source (size and content) before the source is deleted. If
+    anything goes wrong during the copy, the partial destination is removed and the
+    source is untouched.
+    """
+    dst = os.path.join(dst_dir, os.path.basename(os.path.normpath(src)))
+    if os.path.exists(dst):
+        raise ArchiveError(f"Destination '{dst}' already exists")
+
+    if is_same_device(src, dst_dir):
+        logger.debug(f"Same device: rename '{src}' to '{dst}'")
+        os.rename(src, dst)
+        return dst
+
+    logger.info("Different devices: copying (source deleted only after checks)")
+    try:
+        _copy_tree_verified(src, dst, parallel)
+    except Exception:
+        # rollback : source is still complete
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+    shutil.rmtree(src)
+    return dst
+
+
+def _copy_tree_verified(src, dst, parallel):
+    files = []
+    for root, _, filenames in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+        for filename in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_root, filename))
+            files.append(rel_path)
+
+    def copy(rel_path):
+        src_path = os.path.join(src, rel_path)
+        dst_path = os.path.join(dst, rel_path)
+        shutil.copy2(src_path, dst_path)
+        src_size = os.path.getsize(src_path)
+        dst_size = os.path.getsize(dst_path)
+        if src_size != dst_size:
+            raise ArchiveError(
+                f"Size mismatch for '{rel_path}': {src_size} != {dst_size}"
+            )
+        # byte by byte: the source is deleted after
+        if not filecmp.cmp(src_path, dst_path, shallow=False):
+            raise ArchiveError(f"Content mismatch for '{rel_path}'")
+
+    with ThreadPoolExecutor(parallel) as executor:
+        # list to raise the first exception if any
+        list(executor.map(copy, files))
+
+    shutil.copystat(src, dst)
+    logger.info(f"{len(files)} files copied and checked")
@@ -0,0 +1,114 @@
+from datetime import datetime, time as dt_time
+import logging
+import multiprocessing
+import re
+import time
+
+from .worker_pool import register_worker_setup
+
+logger = logging.getLogger(__name__)
+
+RATE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$", re.IGNORECASE)
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+SCHEDULE_REGEX = re.compile(r"^\s*(\d\d?:\d\d)-(\d\d?:\d\d)\s*=\s*(.+)$")
+
+
+def parse_rate(value):
+    """Bytes/s from 500K, 2M, 1.5MB... 0 or off: no limit"""
+    if value.strip().lower() in ("0", "off", "none"):
+        return 0
+    m = RATE_REGEX.match(value)
+    if not m:
+        raise ValueError(f"Invalid rate '{value}' (expected like 500K, 2M)")
+    number, unit = m.groups()
+    return int(float(number) * RATE_UNITS[unit.upper()])
+
+
+def parse_schedule(value):
+    """[(start, end, rate)] from 08:00-19:00=1M,19:00-08:00=off"""
+    schedule = []
+    for item in value.split(","):
+        m = SCHEDULE_REGEX.match(item)
+        if not m:
+            raise ValueError(
+                f"Invalid schedule '{item}' (expected like 08:00-19:00=1M)"
+            )
+        start, end, rate = m.groups()
+        schedule.append(
+            (
+                dt_time.fromisoformat(start.zfill(5)),
+                dt_time.fromisoformat(end.zfill(5)),
+                parse_rate(rate),
+            )
+        )
+    return schedule
+
+
+def _in_period(start, end, t):
+    if start <= end:
+        return start <= t < end
+    # over midnight
+    return t >= start or t < end
+
+
+class TokenBucket:
+    """Byte rate limit shared by the processes that inherit it (pool workers)
+
+    Tokens can go negative: the transfer that takes them waits for the debt to be
+    refilled, so chunks larger than the bucket are fine and the rate is kept over
+    all the concurrent transfers.
+    """
+
+    def __init__(self, rate, schedule=None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.RawValue("d", 0)
+        self._updated = multiprocessing.RawValue("d", time.monotonic())
+
+    def current_rate(self):
+        now = datetime.now().time()
+        for start, end, rate in self.schedule:
+            if _in_period(start, end, now):
+                return rate
+        return self.rate
+
+    def consume(self, num_bytes):
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # at most 1 s of burst after idle
+            tokens = self._tokens.value + (now - self._updated.value) * rate
+            tokens = min(tokens, rate) - num_bytes
+            self._tokens.value = tokens
+            self._updated.value = now
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+
+# shared by all the transfers of the process (and the pool workers)
+_bucket = None
+
+
+def enable(rate, schedule=None):
+    global _bucket
+    _bucket = TokenBucket(rate, schedule)
+    register_worker_setup(_init_worker, _bucket)
+
+
+def _init_worker(bucket):
+    global _bucket
+    _bucket = bucket
+
+
+def is_limited():
+    return _bucket is not None
+
+
+def throttle(num_bytes):
+    """Wait so the bytes transferred stay under the limit (if any)"""
+    if _bucket:
+        _bucket.consume(num_bytes)
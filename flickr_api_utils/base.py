@@ -5,9 +5,19 @@ import click
 
 logger = logging.getLogger(__name__)
 
+# ctx.meta key (shared by all the contexts) of the subcommand path like "album info"
+COMMAND_PATH_META = f"{__package__}.command_path"
+
 
 class CatchAllExceptionsCommand(click.Command):
     def invoke(self, ctx):
+        names = []
+        parent = ctx
+        while parent.parent:
+            names.append(parent.info_name)
+            parent = parent.parent
+        ctx.meta[COMMAND_PATH_META] = " ".join(reversed(names))
+
         try:
             return super().invoke(ctx)
         except Exception as ex:
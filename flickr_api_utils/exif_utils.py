@@ -0,0 +1,48 @@
+from PIL import ExifTags, Image
+
+
+def read_date_taken(filepath):
+    """EXIF DateTimeOriginal (YYYY:MM:DD HH:MM:SS) or None if not present
+
+    Only the header of the file is read (the pixels are not decoded), unlike
+    piexif.load which reads the whole file.
+    """
+    with Image.open(filepath) as im:
+        exif_ifd = im.getexif().get_ifd(ExifTags.IFD.Exif)
+        date_taken = exif_ifd.get(ExifTags.Base.DateTimeOriginal)
+
+    if isinstance(date_taken, bytes):
+        date_taken = date_taken.decode("ascii")
+    if date_taken:
+        # can be null terminated
+        date_taken = date_taken.strip("\x00 ")
+    return date_taken or None
+
+
+def read_gps(filepath):
+    """(latitude, longitude) in decimal degrees from the EXIF or None if not present"""
+    with Image.open(filepath) as im:
+        gps_ifd = im.getexif().get_ifd(ExifTags.IFD.GPSInfo)
+
+    latitude = _to_degrees(
+        gps_ifd.get(ExifTags.GPS.GPSLatitude), gps_ifd.get(ExifTags.GPS.GPSLatitudeRef)
+    )
+    longitude = _to_degrees(
+        gps_ifd.get(ExifTags.GPS.GPSLongitude),
+        gps_ifd.get(ExifTags.GPS.GPSLongitudeRef),
+    )
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude
+
+
+def _to_degrees(dms, ref):
+    # (degrees, minutes, seconds) as rationals ; ref N / S or E / W
+    if not dms or len(dms) != 3:
+        return None
+    degrees = float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+    if isinstance(ref, bytes):
+        ref = ref.decode("ascii")
+    if ref and ref.strip("\x00 ").upper() in ("S", "W"):
+        degrees = -degrees
+    return degrees
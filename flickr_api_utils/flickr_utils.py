@@ -1,19 +1,82 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from enum import Enum, auto
+from itertools import pairwise
 import logging
+from operator import attrgetter
+import threading
+from time import monotonic, sleep
 
 from addict import Dict as Addict
+from attrs import define, fields
+
+from .metrics import metrics
+from .trace import tracer
 
 logger = logging.getLogger(__name__)
 
+# max allowed by the Flickr API for photos.search
+MAX_PER_PAGE = 500
+
+API_RETRIES = 6
+
+NCOLS = 80
+
+# seconds
+CHECK_TICKETS_SLEEP = 3
+MAX_NUM_CHECKS = 10
+
+PhotoTicketStatus = namedtuple("PhotoTicketStatus", "status photo_id filepath order")
+
+
+class UploadError(Exception):
+    pass
+
+
+class TicketStatusEnum(Enum):
+    INCOMPLETE = auto()
+    COMPLETE = auto()
+    INVALID = auto()
+
+
+@define
+class PhotoRecord:
+    """Photo from a paginated listing (photosets.getPhotos, photos.search)
+
+    Only the fields below are kept: None if not in the response (extra not requested).
+    """
+
+    id: str
+    title: str = None
+    owner: str = None
+    ownername: str = None
+    pathalias: str = None
+    isprimary: str = None
+    datetaken: str = None
+    dateupload: str = None
+    tags: str = None
+    views: str = None
+    latitude: float = None
+    longitude: float = None
+    url_o: str = None
 
-def all_pages(page_elem, iter_elem, func, *args, **kwargs):
+    @classmethod
+    def from_json(cls, photo):
+        return cls(*map(photo.get, _PHOTO_RECORD_FIELDS))
+
+
+_PHOTO_RECORD_FIELDS = [f.name for f in fields(PhotoRecord)]
+
+
+def all_pages(page_elem, iter_elem, func, *args, item_type=Addict, **kwargs):
     page = 1
     acc = []
     while True:
-        paginated = Addict(func(*args, **kwargs, page=page))[page_elem]
-        acc.extend(paginated[iter_elem])
+        paginated = func(*args, **kwargs, page=page)[page_elem]
+        acc.extend(map(item_type, paginated[iter_elem]))
 
-        if int(paginated.page) >= int(paginated.pages):
+        if int(paginated["page"]) >= int(paginated["pages"]):
             return acc
 
         page += 1
@@ -34,17 +97,38 @@ def get_photos(flickr, album_id, extras="date_taken,url_o", **kwargs):
         flickr.photosets.getPhotos,
         photoset_id=album_id,
         extras=extras,
+        item_type=PhotoRecord.from_json,
         **kwargs,
     )
 
 
-def all_pages_generator(page_elem, iter_elem, func, *args, **kwargs):
+def is_sorted_by_date_taken(photos):
+    # single pass: no need to sort to know if the order is already fine
+    return all(a.datetaken <= b.datetaken for a, b in pairwise(photos))
+
+
+def reorder_by_date_taken(flickr, album_id, photos):
+    """Reorder the photos of the album by date taken
+
+    photos: the photos of the album in the current order. Nothing is sent to Flickr if
+    already in order. Returns True if the album was reordered.
+    """
+    if is_sorted_by_date_taken(photos):
+        return False
+
+    photos = sorted(photos, key=attrgetter("datetaken"))
+    q_photo_ids = ",".join(map(attrgetter("id"), photos))
+    flickr.photosets.reorderPhotos(photoset_id=album_id, photo_ids=q_photo_ids)
+    return True
+
+
+def all_pages_generator(page_elem, iter_elem, func, *args, item_type=Addict, **kwargs):
     page = 1
     while True:
-        paginated = Addict(func(*args, **kwargs, page=page))[page_elem]
-        yield paginated[iter_elem]
+        paginated = func(*args, **kwargs, page=page)[page_elem]
+        yield list(map(item_type, paginated[iter_elem]))
 
-        if int(paginated.page) >= int(paginated.pages):
+        if int(paginated["page"]) >= int(paginated["pages"]):
             return
 
         page += 1
@@ -60,22 +144,11 @@ def get_photostream_photos(
     override_safeguard=False,  # safeguard to prevent mistakes when no d start indicated
     **kwargs,
 ):
-    date_s = None
-    if start_photo_id:
-        info_s = Addict(flickr.photos.getInfo(photo_id=start_photo_id))
-        # UNIX timestamp
-        date_s = int(info_s.photo.dates.posted)
-
-        dt_s = datetime.fromtimestamp(date_s)
-        logger.info(f"Start: {dt_s}")
-
-    date_e = None
-    if end_photo_id:
-        info_e = Addict(flickr.photos.getInfo(photo_id=end_photo_id))
-        date_e = int(info_e.photo.dates.posted)
-
-        dt_e = datetime.fromtimestamp(date_e)
-        logger.info(f"End: {dt_e} ")
+    date_s, date_e = get_posted_dates(flickr, start_photo_id, end_photo_id)
+    if date_s:
+        logger.info(f"Start: {datetime.fromtimestamp(date_s)}")
+    if date_e:
+        logger.info(f"End: {datetime.fromtimestamp(date_e)} ")
 
     if not date_e and not date_s and not limit:
         raise ValueError("No dates and no limit: All photos would be returned.")
@@ -109,12 +182,17 @@ def get_photostream_photos(
     if date_e:
         kwargs.update(max_upload_date=date_e)
 
+    if limit and "per_page" not in kwargs:
+        # so a small limit is a single small request
+        kwargs.update(per_page=min(limit, MAX_PER_PAGE))
+
     counter = 0
     for photos in all_pages_generator(
         "photos",
         "photo",
         flickr.photos.search,
         user_id="me",
+        item_type=PhotoRecord.from_json,
         **kwargs,
     ):
         for photo in photos:
@@ -127,6 +205,47 @@ def get_photostream_photos(
                 return
 
 
+def get_posted_dates(flickr, *photo_ids):
+    """UNIX timestamps of the date posted of the photos (None if no photo ID)
+
+    The getInfo calls are done concurrently.
+    """
+
+    def get_posted_date(photo_id):
+        if not photo_id:
+            return None
+        info = Addict(flickr.photos.getInfo(photo_id=photo_id))
+        return int(info.photo.dates.posted)
+
+    if not any(photo_ids):
+        return [None] * len(photo_ids)
+
+    with ThreadPoolExecutor(len(photo_ids)) as executor:
+        return list(executor.map(get_posted_date, photo_ids))
+
+
+class RateLimiter:
+    """Spaces the calls (from any thread) by at least 1 / rate seconds"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+
+def to_flickr_date(exif_date):
+    """EXIF date (YYYY:MM:DD HH:MM:SS) to Flickr date taken (YYYY-MM-DD HH:MM:SS)"""
+    return exif_date[:10].replace(":", "-") + exif_date[10:]
+
+
 def format_tags(tags):
     if tags:
         # check if there is  a " in the tag values: will not be valid for Flickr
@@ -137,3 +256,62 @@ def format_tags(tags):
         # space separated for API
         return " ".join(tag_list)
     return None
+
+
+@metrics.stage("ticket polling")
+def check_tickets(flickr, photo_status):
+    """Poll the async upload tickets until none is incomplete (or too many checks)
+
+    photo_status: PhotoTicketStatus by ticket ID, updated with the status and photo ID
+    """
+    num_checks = 0
+    while True:
+        tickets_to_check = [
+            ticket_id
+            for ticket_id, s in photo_status.items()
+            if s.status == TicketStatusEnum.INCOMPLETE
+        ]
+        if not tickets_to_check:
+            # all uploads failed ?
+            break
+
+        tickets_string = ",".join(tickets_to_check)
+        resp = flickr.photos.upload.checkTickets(tickets=tickets_string)
+        resp = Addict(resp)
+        ticket_statuses = resp.uploader.ticket
+        if not isinstance(ticket_statuses, list):
+            # if only 1 result, then is not a list
+            ticket_statuses = [ticket_statuses]
+
+        incomplete_photos = False
+        for status in ticket_statuses:
+            ticket_id = status.id
+            current_status = photo_status[ticket_id]
+
+            if status.complete == 0:
+                # not finished : do another pass for that ticket
+                incomplete_photos = True
+            elif status.complete == 1:
+                # OK
+                photo_id = status.photoid
+                photo_status[ticket_id] = current_status._replace(
+                    status=TicketStatusEnum.COMPLETE, photo_id=photo_id
+                )
+            elif status.complete == 2:
+                # invalid
+                photo_status[ticket_id] = current_status._replace(
+                    status=TicketStatusEnum.INVALID,
+                )
+            else:
+                logger.error(f"Unknown status {status.complete}")
+
+        if incomplete_photos:
+            num_checks += 1
+            if num_checks >= MAX_NUM_CHECKS:
+                break
+            with tracer.span("ticket poll wait", "upload"):
+                sleep(CHECK_TICKETS_SLEEP)
+        else:
+            break
+
+    return photo_status
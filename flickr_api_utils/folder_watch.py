@@ -0,0 +1,57 @@
+import os
+
+
+class FolderWatcher:
+    """Files of a folder created or modified since the last poll
+
+    Polling of the modification times instead of inotify / FSEvents: same on macOS
+    and Linux, and works on external drives. A file is reported once it has not
+    changed between 2 polls, so not while it is still being written.
+
+    extensions: lower case, with the dot
+    """
+
+    def __init__(self, folder, extensions, skip_existing=False):
+        self.folder = folder
+        self.extensions = extensions
+        # (mtime, size) by path: already reported
+        self._seen = self._scan() if skip_existing else {}
+        # (mtime, size) by path: changed, reported if the same at the next poll
+        self._pending = {}
+
+    def _scan(self):
+        stats = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[-1].lower() not in self.extensions:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # deleted during the scan
+                    continue
+                stats[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def poll(self):
+        """Paths of the files changed and now stable (sorted)"""
+        stats = self._scan()
+        changed = []
+        for path, stat in stats.items():
+            if self._seen.get(path) == stat:
+                self._pending.pop(path, None)
+            elif self._pending.get(path) == stat:
+                del self._pending[path]
+                self._seen[path] = stat
+                changed.append(path)
+            else:
+                self._pending[path] = stat
+
+        # deleted or renamed
+        for files in (self._seen, self._pending):
+            for path in [path for path in files if path not in stats]:
+                del files[path]
+
+        return sorted(changed)
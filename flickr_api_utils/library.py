@@ -0,0 +1,149 @@
+from collections import defaultdict
+from datetime import UTC, datetime
+import logging
+
+import click
+from tqdm import tqdm
+
+from .api_auth import auth_flickr
+from .base import CatchAllExceptionsCommand
+from .flickr_utils import (
+    MAX_PER_PAGE,
+    NCOLS,
+    PhotoRecord,
+    all_pages_generator,
+    get_albums,
+    get_photos,
+)
+
+logger = logging.getLogger(__name__)
+
+EXPORT_EXTRAS = "date_taken,date_upload,views,tags,geo"
+
+
+@click.group("library")
+def library():
+    """Whole library operations."""
+    pass
+
+
+@library.command("export", cls=CatchAllExceptionsCommand)
+@click.option(
+    "--output",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="Output file",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["parquet", "arrow"]),
+    default="parquet",
+    help="Columnar format of the output file",
+)
+@click.option(
+    "--albums/--no-albums",
+    "is_albums",
+    default=True,
+    help="Include album membership (one listing per album)",
+)
+def export(output, output_format, is_albums):
+    """Export the metadata of all the photos to a columnar file.
+
+    Columns: id, title, date_taken, date_upload, views, tags, albums, latitude,
+    longitude. Photos are written page by page so memory stays bounded.
+    """
+    # Import here to make it optional
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as ex:
+        raise click.ClickException(
+            "pyarrow is required for this command. Install it with: pip install pyarrow"
+        ) from ex
+
+    flickr = auth_flickr()
+
+    photo_albums = defaultdict(list)
+    if is_albums:
+        albums = get_albums(flickr)
+        for album_data in tqdm(albums, desc="Listing albums...", ncols=NCOLS):
+            for photo in get_photos(
+                flickr, album_data.id, extras="", per_page=MAX_PER_PAGE
+            ):
+                photo_albums[photo.id].append(album_data.id)
+
+    schema = pa.schema(
+        [
+            ("id", pa.string()),
+            ("title", pa.string()),
+            ("date_taken", pa.timestamp("s")),
+            ("date_upload", pa.timestamp("s", tz="UTC")),
+            ("views", pa.int64()),
+            ("tags", pa.list_(pa.string())),
+            ("albums", pa.list_(pa.string())),
+            ("latitude", pa.float64()),
+            ("longitude", pa.float64()),
+        ]
+    )
+
+    if output_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(output, schema)
+    else:
+        writer = pyarrow.ipc.new_file(output, schema)
+
+    count = 0
+    progress_bar = tqdm(desc="Exporting...", unit=" photos", ncols=NCOLS)
+    with writer:
+        for photos in all_pages_generator(
+            "photos",
+            "photo",
+            flickr.photos.search,
+            user_id="me",
+            extras=EXPORT_EXTRAS,
+            per_page=MAX_PER_PAGE,
+            item_type=PhotoRecord.from_json,
+        ):
+            if not photos:
+                continue
+            columns = _to_columns(photos, photo_albums)
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            count += len(photos)
+            progress_bar.update(len(photos))
+    progress_bar.close()
+
+    logger.info(f"{count} photos exported to {output}")
+
+
+def _to_columns(photos, photo_albums):
+    columns = defaultdict(list)
+    for photo in photos:
+        # no geo : 0 from the API (number or string)
+        latitude = float(photo.latitude or 0)
+        longitude = float(photo.longitude or 0)
+        has_geo = bool(latitude or longitude)
+        columns["id"].append(photo.id)
+        columns["title"].append(photo.title)
+        columns["date_taken"].append(_parse_date_taken(photo.datetaken))
+        columns["date_upload"].append(
+            datetime.fromtimestamp(int(photo.dateupload), UTC)
+            if photo.dateupload
+            else None
+        )
+        columns["views"].append(int(photo.views) if photo.views else None)
+        columns["tags"].append(photo.tags.split() if photo.tags else [])
+        columns["albums"].append(photo_albums.get(photo.id, []))
+        columns["latitude"].append(latitude if has_geo else None)
+        columns["longitude"].append(longitude if has_geo else None)
+    return columns
+
+
+def _parse_date_taken(date_taken):
+    if not date_taken:
+        return None
+    try:
+        return datetime.fromisoformat(date_taken)
+    except ValueError:
+        # Flickr can return invalid dates like 0000-00-00 for unknown dates
+        return None
@@ -1,8 +1,10 @@
+from array import array
+from bisect import bisect_left
 from collections import namedtuple
 import ctypes
 from ctypes.macholib.dyld import dyld_find
 import ctypes.util
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
 import fnmatch
 import logging
 import os
@@ -351,11 +353,10 @@ def dirname_with_date(parent_folder, name, f_date):
 
 def dirs_with_date(folder, subfolder=None):
     date_pattern = re.compile(r"^\d{8}_")
-    items = os.listdir(folder)
     date_folders = [
-        item
-        for item in items
-        if os.path.isdir(os.path.join(folder, item)) and date_pattern.match(item)
+        entry.name
+        for entry in os.scandir(folder)
+        if date_pattern.match(entry.name) and entry.is_dir()
     ]
 
     if subfolder:
@@ -376,7 +377,7 @@ def is_since(date_s):
     return date_s.startswith(PREFIX_SINCE)
 
 
-def to_dates(date_s, volume: PhotoVolume):
+def to_dates(date_s, volume: PhotoVolume, card_index):
     if date_s == "TD":
         return datetime.now().date()
 
@@ -391,13 +392,13 @@ def to_dates(date_s, volume: PhotoVolume):
 
     if date_s == "L":
         # L for latest
-        return find_latest_date(volume.path)
+        return find_latest_date(card_index)
 
     if date_s == "L2":
-        return find_latest_date(volume.path, rank=1)
+        return find_latest_date(card_index, rank=1)
 
     if date_s == "L3":
-        return find_latest_date(volume.path, rank=2)
+        return find_latest_date(card_index, rank=2)
 
     if "-" in date_s:
         return parse_date_range(date_s)
@@ -428,7 +429,7 @@ def to_dates(date_s, volume: PhotoVolume):
         # only first 8 characters in case title copied
         date_s = date_s[:8]
         date_since = datetime.strptime(date_s, "%Y%m%d").date()
-        filtered = filter_after(find_all_dates(volume.path), date_since)
+        filtered = card_index.dates_after(date_since)
         if not filtered:
             logger.warning("No photo since last date.")
         return filtered
@@ -448,30 +449,78 @@ def parse_date_range(date_range_str):
     return DateRange(start_date, end_date)
 
 
-def find_latest_date(volume_path, rank=0):
-    dates = find_all_dates(volume_path)
-    if not dates:
+def find_latest_date(card_index, rank=0):
+    dates = card_index.dates()
+    if len(dates) <= rank:
         return None
     return dates[rank]
 
 
-def find_all_dates(volume_path):
-    dates = []
-    for root, _, filenames in os.walk(volume_path):
-        for filename in filenames:
-            if not filter_relevant_image(filename):
-                continue
-            file_path = os.path.join(root, filename)
-            last_modified_date = datetime.fromtimestamp(os.path.getmtime(file_path))
-            dates.append(last_modified_date.date())
-    if not dates:
-        return None
-    dates = list(set(dates))
-    return sorted(dates, reverse=True)
+def day_start_ts(d):
+    # local time like the dates derived from the mtimes
+    return datetime.combine(d, time()).timestamp()
 
 
-def filter_after(dates, date_after):
-    return [d for d in dates if d > date_after]
+class CardIndex:
+    """Relevant files of a volume sorted by mtime.
+
+    Built with a single walk of the card (slow readers) then used to answer all the
+    date specs and the copy with bisections on the mtimes.
+    """
+
+    def __init__(self, entries):
+        entries = sorted(entries)
+        self.mtimes = array("d", (e[0] for e in entries))
+        self.paths = [e[1] for e in entries]
+        self.sizes = array("q", (e[2] for e in entries))
+
+    @classmethod
+    def build(cls, volume_path):
+        entries = []
+        folders = [volume_path]
+        while folders:
+            with os.scandir(folders.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif filter_relevant_image(entry.name):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.mtimes)
+
+    def dates(self, start=0):
+        """Distinct dates (of the files from index start), most recent first"""
+        dates = []
+        i = start
+        while i < len(self.mtimes):
+            d = datetime.fromtimestamp(self.mtimes[i]).date()
+            dates.append(d)
+            # jump to the first file of the next day
+            i = bisect_left(self.mtimes, day_start_ts(d + timedelta(days=1)), lo=i)
+        return dates[::-1]
+
+    def dates_after(self, date_after):
+        start = bisect_left(self.mtimes, day_start_ts(date_after + timedelta(days=1)))
+        return self.dates(start)
+
+    def select(self, f_date):
+        """Indices range of the files for a date or a DateRange"""
+        if isinstance(f_date, DateRange):
+            start_date, end_date = f_date.start, f_date.end
+        else:
+            start_date = end_date = f_date
+
+        start = 0
+        if start_date:
+            start = bisect_left(self.mtimes, day_start_ts(start_date))
+        end = len(self.mtimes)
+        if end_date:
+            end_ts = day_start_ts(end_date + timedelta(days=1))
+            end = bisect_left(self.mtimes, end_ts, lo=start)
+        return range(start, end)
 
 
 def get_volume(media):
@@ -493,36 +542,22 @@ def filter_relevant_image(filename):
     return filename.lower().endswith((".jpg", ".jpeg", ".raf", ".raw", ".m4a", ".avi"))
 
 
-def filter_by_date(image_date, date_):
-    if isinstance(date_, DateRange):
-        if date_.start and image_date < date_.start:
-            return False
-        if date_.end and image_date > date_.end:
-            return False
-        return True
-    return image_date == date_
-
-
-def copy_to_folder(volume: PhotoVolume, folder_base, f_date):
+def copy_to_folder(volume: PhotoVolume, folder_base, f_date, card_index):
     os.makedirs(folder_base, exist_ok=True)
 
     media_folder = MEDIA_FOLDER_MAPPING[volume.name]
     output_folder = os.path.join(folder_base, media_folder)
     os.makedirs(output_folder, exist_ok=True)
 
-    counter = 0
-    for root, _, filenames in os.walk(volume.path):
-        for filename in filenames:
-            if not filter_relevant_image(filename):
-                continue
-            file_path = os.path.join(root, filename)
-            last_modified_date = datetime.fromtimestamp(os.path.getmtime(file_path))
+    selected = card_index.select(f_date)
+    total_size = sum(card_index.sizes[i] for i in selected)
+    logger.info(f"{len(selected)} files ({total_size / 1e6:.0f} MB)")
 
-            if filter_by_date(last_modified_date.date(), f_date):
-                counter += 1
-                if counter % 20 == 0:
-                    logger.info(f"Copy #{counter}: {file_path}")
-                shutil.copy2(file_path, output_folder)
+    for counter, i in enumerate(selected, start=1):
+        file_path = card_index.paths[i]
+        if counter % 20 == 0:
+            logger.info(f"Copy #{counter}: {file_path}")
+        shutil.copy2(file_path, output_folder)
 
 
 @local.command("copy-sd", cls=CatchAllExceptionsCommand)
@@ -556,9 +591,13 @@ def copy_sd(name, date_spec, is_eject):
         logger.error("No relevant SD card. Volume not renamed?")
         return
 
-    dates = to_dates(date_spec, volume)
+    logger.info(f"Indexing {volume.path} ...")
+    card_index = CardIndex.build(volume.path)
+    logger.info(f"{len(card_index)} files on the card")
+
+    dates = to_dates(date_spec, volume, card_index)
     if not isinstance(dates, list):
-        dates = [dates]
+        dates = [dates] if dates else []
     if not dates:
         logger.info("No image found: Is the SD card inserted and mounted?")
         return
@@ -582,7 +621,7 @@ def copy_sd(name, date_spec, is_eject):
     for i, f_date in enumerate(dates):
         folder_base = output_folder_base[i]
         logger.info(f"Copy to {folder_base} (date: {f_date}) ...")
-        copy_to_folder(volume, folder_base, f_date)
+        copy_to_folder(volume, folder_base, f_date, card_index)
 
     try:
         if is_eject:
@@ -0,0 +1,167 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+
+from .trace import tracer
+from .worker_pool import register_worker_collector
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+
+class Metrics:
+    """API call latencies, retries, bytes transferred and stage wall times
+
+    Thread-safe. Nothing is recorded unless enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        # new lock: a forked worker can get a copy of a lock held by another thread
+        self._lock = threading.Lock()
+        # latencies in seconds by method
+        self.calls = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.bytes = defaultdict(int)
+        # [count, seconds] by stage
+        self.stages = defaultdict(lambda: [0, 0.0])
+
+    @contextmanager
+    def api_call(self, method):
+        start = time.monotonic()
+        is_error = True
+        try:
+            with tracer.span(method, "api"):
+                yield
+            is_error = False
+        finally:
+            if self.enabled:
+                elapsed = time.monotonic() - start
+                with self._lock:
+                    self.calls[method].append(elapsed)
+                    if is_error:
+                        self.errors[method] += 1
+
+    def record_retry(self, method):
+        if self.enabled:
+            with self._lock:
+                self.retries[method] += 1
+
+    def add_bytes(self, kind, num_bytes):
+        if self.enabled:
+            with self._lock:
+                self.bytes[kind] += num_bytes
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            with tracer.span(name, "stage"):
+                yield
+        finally:
+            if self.enabled:
+                elapsed = time.monotonic() - start
+                with self._lock:
+                    self.stages[name][0] += 1
+                    self.stages[name][1] += elapsed
+
+    def to_data(self):
+        with self._lock:
+            return dict(
+                calls=dict(self.calls),
+                errors=dict(self.errors),
+                retries=dict(self.retries),
+                bytes=dict(self.bytes),
+                stages=dict(self.stages),
+            )
+
+    def merge(self, data):
+        with self._lock:
+            for method, latencies in data["calls"].items():
+                self.calls[method].extend(latencies)
+            for name in ("errors", "retries", "bytes"):
+                counter = getattr(self, name)
+                for key, value in data[name].items():
+                    counter[key] += value
+            for name, (count, seconds) in data["stages"].items():
+                self.stages[name][0] += count
+                self.stages[name][1] += seconds
+
+    def summary(self):
+        with self._lock:
+            api_calls = {}
+            for method, latencies in sorted(self.calls.items()):
+                latencies = sorted(latencies)
+                api_calls[method] = dict(
+                    count=len(latencies),
+                    errors=self.errors.get(method, 0),
+                    retries=self.retries.get(method, 0),
+                    total_s=round(sum(latencies), 3),
+                    **{
+                        f"p{p}_s": round(_percentile(latencies, p), 3)
+                        for p in PERCENTILES
+                    },
+                    max_s=round(latencies[-1], 3),
+                )
+            stages = {
+                name: dict(count=count, wall_s=round(seconds, 3))
+                for name, (count, seconds) in self.stages.items()
+            }
+            return dict(api_calls=api_calls, stages=stages, bytes=dict(self.bytes))
+
+
+def _percentile(sorted_values, p):
+    # nearest rank
+    index = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[index]
+
+
+metrics = Metrics()
+
+# main process: merges the metrics of the pool workers
+_merge_workers = None
+_start = None
+
+
+def enable():
+    global _merge_workers, _start
+    metrics.enabled = True
+    _start = time.monotonic()
+    _merge_workers = register_worker_collector(
+        "metrics", _worker_data, metrics.merge, setup=_init_worker
+    )
+
+
+def _init_worker():
+    # forked workers have a copy of the main process metrics
+    metrics.reset()
+    metrics.enabled = True
+
+
+# module function (not a bound method): also picklable for the spawn start method
+def _worker_data():
+    return metrics.to_data()
+
+
+def write_report(path, command):
+    """Write the summary of the run (main process + pool workers) as JSON"""
+    _merge_workers()
+
+    report = dict(
+        command=command,
+        date=datetime.now().isoformat(),
+        wall_s=round(time.monotonic() - _start, 3),
+        **metrics.summary(),
+    )
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Metrics written to {path}")
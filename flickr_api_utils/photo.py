@@ -1,22 +1,59 @@
 from datetime import datetime
 from fnmatch import fnmatch
+from functools import partial
+import json
 import logging
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
 import os
 import re
 import shutil
+import threading
+import time
 
 from addict import Dict as Addict
 import click
-import piexif
 import requests
+from tqdm import tqdm
 
 from .api_auth import auth_flickr
+from .bandwidth import throttle
 from .base import CatchAllExceptionsCommand
-from .flickr_utils import format_tags, get_photos, get_photostream_photos
+from .exif_utils import read_date_taken
+from .flickr_utils import (
+    API_RETRIES,
+    MAX_PER_PAGE,
+    NCOLS,
+    PhotoRecord,
+    PhotoTicketStatus,
+    RateLimiter,
+    TicketStatusEnum,
+    UploadError,
+    all_pages_generator,
+    check_tickets,
+    format_tags,
+    get_photos,
+    get_photostream_photos,
+    to_flickr_date,
+)
+from .metrics import metrics
+from .retry_policy import retry
+from .trace import tracer
+from .upload_stream import ProgressFile
 from .url_utils import extract_album_id, extract_photo_id
+from .worker_pool import Pool
 
 logger = logging.getLogger(__name__)
 
+DESCRIPTION_CONCURRENCY = 4
+REPLACE_CONCURRENCY = 2
+# seconds
+REPLACE_TIMEOUT = 60
+CORRECT_DATE_CONCURRENCY = 4
+# calls per second
+CORRECT_DATE_RATE = 10
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 @click.group("photo")
 def photo():
@@ -79,10 +116,8 @@ def download(album, output, start_id, end_id):
             else:
                 url = image.url_o
                 logger.info(f"Downloading {url}...")
-                resp = requests.get(url)
-                resp.raise_for_status()
-                with open(new_path, "wb") as f:
-                    f.write(resp.content)
+                with metrics.api_call("download"):
+                    _download(url, new_path)
         except Exception:
             logger.exception("An error occurred")
             continue
@@ -92,6 +127,19 @@ def download(album, output, start_id, end_id):
             break
 
 
+def _download(url, path):
+    with requests.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        # not written under the final name if interrupted
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                metrics.add_bytes("download", len(chunk))
+                throttle(len(chunk))
+        os.replace(tmp_path, path)
+
+
 @photo.command(cls=CatchAllExceptionsCommand)
 @click.option(
     "--album",
@@ -109,7 +157,18 @@ def download(album, output, start_id, end_id):
     default="*.JPG",
     help="File pattern to match (e.g., 'DSCF*.JPG')",
 )
-def replace(album, folder, pattern):
+@click.option(
+    "--parallel",
+    default=REPLACE_CONCURRENCY,
+    help="Number of parallel replacements",
+)
+@click.option(
+    "--async/--no-async",
+    "is_async",
+    default=True,
+    help="Asynchronous replace (checked with the upload tickets)",
+)
+def replace(album, folder, pattern, parallel, is_async):
     """Replace photos in an album with local files.
 
     Matches photos by EXIF date taken timestamp.
@@ -126,46 +185,127 @@ def replace(album, folder, pattern):
             user_path = user_id
         return f"https://www.flickr.com/photos/{user_path}/{photo.id}"
 
-    photos = list(get_photos(flickr, album_id, extras="date_taken,url_o,path_alias"))
-
-    flickr_time_index = {}
-    for photo in photos:
-        date_taken = photo.datetaken
-        flickr_time_index[date_taken] = photo
-
-    photo_time_index = {}
-    for file_name in os.listdir(folder):
-        if fnmatch(file_name, pattern):
-            file_path = os.path.join(folder, file_name)
-            try:
-                exif_data = piexif.load(file_path)
-                dt_original = exif_data["Exif"][piexif.ExifIFD.DateTimeOriginal]
-                dt_original = dt_original.decode("ascii")
-                dt_format_in = "%Y:%m:%d %H:%M:%S"
-                dt_original = datetime.strptime(dt_original, dt_format_in)
-                dt_format_out = "%Y-%m-%d %H:%M:%S"
-                dt_original = datetime.strftime(dt_original, dt_format_out)
-                photo_time_index[dt_original] = file_path
-            except Exception:
-                logger.error(f"Error reading EXIF from {file_path}")
-                continue
+    photos = get_photos(flickr, album_id, extras="date_taken,path_alias")
+    flickr_time_index = {photo.datetaken: photo for photo in photos}
 
-    for date_taken, file_path in photo_time_index.items():
-        if date_taken not in flickr_time_index:
+    # join on the date taken (in the Flickr format)
+    to_replace = []
+    for file_name in sorted(os.listdir(folder)):
+        if not fnmatch(file_name, pattern):
+            continue
+        file_path = os.path.join(folder, file_name)
+        try:
+            date_taken = read_date_taken(file_path)
+        except Exception:
+            date_taken = None
+        if not date_taken:
+            logger.error(f"Error reading EXIF from {file_path}")
+            continue
+
+        date_taken = to_flickr_date(date_taken)
+        flickr_photo = flickr_time_index.get(date_taken)
+        if not flickr_photo:
             logger.info(
                 f"Photo {file_path} with date {date_taken} not found on Flickr!"
             )
             continue
-        flickr_photo = flickr_time_index[date_taken]
-        logger.info(
-            f"Replace {make_flickr_photo_url(flickr_photo, user.id)} with "
-            f"{file_path}..."
+        to_replace.append((file_path, flickr_photo))
+
+    if not to_replace:
+        logger.warning("Nothing to replace")
+        return
+
+    logger.info(f"{len(to_replace)} photos to replace")
+
+    progress_bar = tqdm(desc="Replacing...", total=len(to_replace), ncols=NCOLS)
+    results = []
+    errors = []
+
+    def _result_callback(result):
+        file_path, flickr_photo, ticket_id, size, elapsed = result
+        results.append(result)
+        progress_bar.write(
+            f"{os.path.basename(file_path)} => "
+            f"{make_flickr_photo_url(flickr_photo, user.id)} "
+            f"({size / 1e6:.1f} MB, {size / elapsed / 1e6:.2f} MB/s)"
         )
-        result = flickr.replace(file_path, flickr_photo.id, format="rest")
-        # not parsed as JSON => bytes
-        result = result.decode("utf-8", "ignore")
-        if 'stat="ok"' not in result:
-            raise click.ClickException(f"Error replacing photo: {result}")
+        progress_bar.update(1)
+
+    def _error_callback(ex):
+        errors.append(ex)
+        progress_bar.write(f"Error during 'Replacing': {ex}")
+
+    start_time = time.monotonic()
+    with metrics.stage("replace"), Pool(parallel) as pool:
+        for file_path, flickr_photo in to_replace:
+            pool.apply_async(
+                replace_photo,
+                (flickr, file_path, flickr_photo, is_async),
+                callback=_result_callback,
+                error_callback=_error_callback,
+            )
+        pool.close()
+        pool.join()
+    progress_bar.close()
+
+    total_elapsed = max(time.monotonic() - start_time, 1e-3)
+    total_size = sum(r[3] for r in results)
+    logger.info(
+        f"{len(results)} files sent: {total_size / 1e6:.1f} MB in "
+        f"{total_elapsed:.1f} s ({total_size / total_elapsed / 1e6:.2f} MB/s)"
+    )
+
+    if is_async and results:
+        photo_status = {
+            ticket_id: PhotoTicketStatus(
+                TicketStatusEnum.INCOMPLETE, flickr_photo.id, file_path, order
+            )
+            for order, (file_path, flickr_photo, ticket_id, _, _) in enumerate(results)
+        }
+        logger.info("Checking ticket statuses...")
+        check_tickets(flickr, photo_status)
+        for s in sorted(photo_status.values(), key=attrgetter("order")):
+            if s.status == TicketStatusEnum.INVALID:
+                errors.append(s)
+                logger.error(f"Replace of {s.photo_id} with {s.filepath} invalid")
+            elif s.status == TicketStatusEnum.INCOMPLETE:
+                logger.warning(
+                    f"Replace of {s.photo_id} with {s.filepath} not complete"
+                )
+
+    if errors:
+        raise click.ClickException(f"{len(errors)} photos not replaced")
+
+
+def replace_photo(flickr, file_path, flickr_photo, is_async, timeout=REPLACE_TIMEOUT):
+    size = os.path.getsize(file_path)
+    kwargs = {"async": 1} if is_async else {}
+
+    def func():
+        # streamed from the file by chunks
+        with ProgressFile(file_path) as fileobj:
+            return flickr.replace(
+                file_path,
+                flickr_photo.id,
+                fileobj=fileobj,
+                format="etree",
+                timeout=timeout,
+                **kwargs,
+            )
+
+    start_time = time.monotonic()
+    try:
+        # error from Flickr raised when parsing the response
+        with tracer.span(os.path.basename(file_path), "replace file"):
+            resp = retry(API_RETRIES, func, method="replace")
+    except Exception as e:
+        msg = f"Error replacing {flickr_photo.id} with {file_path}: {e}"
+        raise UploadError(msg) from e
+    # avoid division by 0 for the throughput
+    elapsed = max(time.monotonic() - start_time, 1e-3)
+
+    ticket_id = resp.find("ticketid").text if is_async else None
+    return file_path, flickr_photo, ticket_id, size, elapsed
 
 
 @photo.command("list-by-date", cls=CatchAllExceptionsCommand)
@@ -174,34 +314,67 @@ def replace(album, folder, pattern):
     required=True,
     help="Date to search for (YYYY-MM-DD)",
 )
+@click.option(
+    "--end-date",
+    help="Last date (YYYY-MM-DD, inclusive) to search for a range of days",
+)
 @click.option(
     "--limit",
     default=5,
     type=int,
-    help="Maximum number of results",
+    help="Maximum number of results (0 for no limit)",
 )
-def list_by_date(date, limit):
-    """List photos taken on a specific date."""
+@click.option(
+    "--description",
+    "is_description",
+    is_flag=True,
+    help="Also show the description (one more API call per photo)",
+)
+def list_by_date(date, end_date, limit, is_description):
+    """List photos taken on a specific date (or a range of dates)."""
     flickr = auth_flickr()
 
-    search_result = Addict(
-        flickr.photos.search(
-            user_id="me",
-            min_taken_date=f"{date} 00:00:00",
-            max_taken_date=f"{date} 23:59:59",
-            per_page=limit,
-        )
-    )
+    end_date = end_date or date
+    logger.info(f"Searching {date} - {end_date}...")
+
+    per_page = min(limit, MAX_PER_PAGE) if limit else MAX_PER_PAGE
+    counter = 0
+    for photos in all_pages_generator(
+        "photos",
+        "photo",
+        flickr.photos.search,
+        user_id="me",
+        min_taken_date=f"{date} 00:00:00",
+        max_taken_date=f"{end_date} 23:59:59",
+        sort="date-taken-asc",
+        # title and owner already in the results: path alias for the URL
+        extras="date_taken,path_alias",
+        per_page=per_page,
+        item_type=PhotoRecord.from_json,
+    ):
+        if limit:
+            photos = photos[: limit - counter]
+
+        descriptions = [None] * len(photos)
+        if is_description:
+            with ThreadPool(DESCRIPTION_CONCURRENCY) as pool:
+                descriptions = pool.map(partial(_get_description, flickr), photos)
+
+        for photo, description in zip(photos, descriptions, strict=True):
+            user_path = photo.pathalias or photo.owner
+            url = f"https://flickr.com/photos/{user_path}/{photo.id}"
+            logger.info(f"{photo.datetaken} {url} {photo.title}")
+            if description:
+                logger.info(f"  {description}")
+
+        counter += len(photos)
+        if limit and counter >= limit:
+            break
 
-    logger.info(f"Searching {date}...")
 
-    for photo in search_result.photos.photo:
-        photo = Addict(flickr.photos.getInfo(photo_id=photo.id)).photo
-        title = photo.title._content
-        owner = photo.owner.nsid
-        id_ = photo.id
-        url = f"https://flickr.com/photos/{owner}/{id_}"
-        logger.info(f"{url} {title}")
+def _get_description(flickr, photo):
+    info = Addict(flickr.photos.getInfo(photo_id=photo.id))
+    return info.photo.description._content
 
 
 SORT_PARAMS = [
@@ -437,69 +610,181 @@ def _add_remove_tags(flickr, photo_id, remove_tags, is_replace, add_tags):
 @photo.command("correct-date", cls=CatchAllExceptionsCommand)
 @click.option(
     "--start-id",
-    required=True,
-    help="Photo ID or URL to start from",
+    help="Photo ID or URL to start from (required unless --resume)",
 )
 @click.option(
     "--end-id",
-    required=True,
-    help="Photo ID or URL to end at",
+    help="Photo ID or URL to end at (required unless --resume)",
 )
 @click.option(
     "--min-date",
-    required=True,
-    help="Minimum date taken (YYYY-MM-DD HH:MM)",
+    help="Minimum date taken (YYYY-MM-DD HH:MM) (required unless --resume)",
 )
 @click.option(
     "--margin-minutes",
     type=int,
-    required=True,
-    help="Margin in minutes from min date",
+    help="Margin in minutes from min date (required unless --resume)",
+)
+@click.option(
+    "--parallel",
+    default=CORRECT_DATE_CONCURRENCY,
+    help="Number of parallel Flickr API calls",
+)
+@click.option(
+    "--rate",
+    type=float,
+    default=CORRECT_DATE_RATE,
+    help="Max number of Flickr API calls per second",
+)
+@click.option(
+    "--plan-file",
+    default="correct_date_plan.json",
+    help="File to save the dates to set (to resume if interrupted)",
+)
+@click.option(
+    "--resume",
+    "is_resume",
+    is_flag=True,
+    help="Resume from the plan file instead of listing the photos again",
 )
-def correct_date(start_id, end_id, min_date, margin_minutes):
+def correct_date(
+    start_id, end_id, min_date, margin_minutes, parallel, rate, plan_file, is_resume
+):
     """Correct date taken for a range of photos.
 
     Used to fix bad "date taken" for photos beyond the max 24 hour shift
     in the Flickr Organizr. Photos before the margin are backdated in
     1-minute increments.
+
+    The dates to set are saved to the plan file before any change: if interrupted,
+    use --resume (the photo range may not be valid anymore since the date posted of
+    some photos has changed).
     """
     from datetime import timedelta
 
     import dateutil.parser
 
-    flickr = auth_flickr()
+    if not is_resume:
+        missing = [
+            option
+            for option, value in (
+                ("--start-id", start_id),
+                ("--end-id", end_id),
+                ("--min-date", min_date),
+                ("--margin-minutes", margin_minutes),
+            )
+            if value is None
+        ]
+        if missing:
+            raise click.UsageError(
+                f"Missing option(s) {', '.join(missing)} (only optional with --resume)"
+            )
 
-    start_photo_id = extract_photo_id(start_id)
-    end_photo_id = extract_photo_id(end_id)
+    flickr = auth_flickr()
 
-    photos_uploaded = []
-    for photos in get_photostream_photos(
-        flickr,
-        start_photo_id=start_photo_id,
-        end_photo_id=end_photo_id,
-        sort="date-posted-asc",
-        extras="date_taken",
-    ):
-        p = Addict(photos)
-        p.datetaken = dateutil.parser.isoparse(p.datetaken)
-        photos_uploaded.append(p)
+    done_file = plan_file + ".done"
+    if is_resume:
+        if not os.path.exists(plan_file):
+            raise click.ClickException(f"No plan file {plan_file} to resume")
+        with open(plan_file, encoding="utf-8") as f:
+            plan = json.load(f)
+        done = set()
+        if os.path.exists(done_file):
+            with open(done_file, encoding="utf-8") as f:
+                done = set(f.read().split())
+        plan = [(photo_id, ts) for photo_id, ts in plan if photo_id not in done]
+        logger.info(f"Resume: {len(done)} photos done, {len(plan)} to do")
+    else:
+        start_photo_id = extract_photo_id(start_id)
+        end_photo_id = extract_photo_id(end_id)
+
+        photos_uploaded = []
+        for photo in get_photostream_photos(
+            flickr,
+            start_photo_id=start_photo_id,
+            end_photo_id=end_photo_id,
+            sort="date-posted-asc",
+            extras="date_taken,date_upload",
+        ):
+            # Flickr format: YYYY-MM-DD HH:MM:SS
+            taken = datetime.fromisoformat(photo.datetaken)
+            photos_uploaded.append((taken, photo))
+
+        min_dt = dateutil.parser.parse(min_date)
+        margin_dt = min_dt + timedelta(minutes=margin_minutes)
+        fake_date = min_dt
+        sorted_photos = list(sorted(photos_uploaded, key=lambda x: x[0]))
+
+        plan = []
+        num_skipped = 0
+        for taken, photo in sorted_photos:
+            if taken > margin_dt:
+                date_posted = taken
+            else:
+                date_posted = fake_date
+            fake_date += timedelta(minutes=1)
 
-    min_dt = dateutil.parser.parse(min_date)
-    margin_dt = min_dt + timedelta(minutes=margin_minutes)
-    fake_date = min_dt
-    sorted_photos = list(sorted(photos_uploaded, key=lambda x: x.datetaken))
+            # unixtime
+            ts = int(date_posted.timestamp())
+            if photo.dateupload and int(photo.dateupload) == ts:
+                num_skipped += 1
+                continue
+            plan.append((photo.id, ts))
 
-    for photo in sorted_photos:
-        taken = photo.datetaken
+        logger.info(f"{len(plan)} dates to set ({num_skipped} already correct)")
+        with open(plan_file, "w", encoding="utf-8") as f:
+            json.dump(plan, f)
+        if os.path.exists(done_file):
+            os.remove(done_file)
 
-        if taken > margin_dt:
-            date_posted = taken
-        else:
-            date_posted = fake_date
+    errors = _set_dates_posted(flickr, plan, parallel, rate, done_file)
+    if errors:
+        raise click.ClickException(
+            f"{errors} dates not set: run again with --resume to retry"
+        )
 
-        # unixtime
-        ts = int(date_posted.timestamp())
-        flickr.photos.setDates(photo_id=photo.id, date_posted=ts)
-        logger.info(f"Posted {photo.id} {date_posted}")
+    os.remove(plan_file)
+    if os.path.exists(done_file):
+        os.remove(done_file)
+    logger.info("All dates set")
+
+
+def _set_dates_posted(flickr, plan, parallel, rate, done_file):
+    rate_limiter = RateLimiter(rate)
+    progress_bar = tqdm(desc="Setting dates...", total=len(plan), ncols=NCOLS)
+    errors = 0
+    lock = threading.Lock()
+
+    def set_date(photo_id, ts):
+        def func():
+            rate_limiter.wait()
+            flickr.photos.setDates(photo_id=photo_id, date_posted=ts, timeout=5)
+
+        retry(API_RETRIES, func, method="flickr.photos.setDates")
+        return photo_id, ts
+
+    def _result_callback(result):
+        photo_id, ts = result
+        with lock:
+            done.write(photo_id + "\n")
+            done.flush()
+        progress_bar.update(1)
+
+    def _error_callback(ex):
+        nonlocal errors
+        errors += 1
+        progress_bar.write(f"Error during 'Setting dates': {ex}")
+
+    with open(done_file, "a", encoding="utf-8") as done, ThreadPool(parallel) as pool:
+        for photo_id, ts in plan:
+            pool.apply_async(
+                set_date,
+                (photo_id, ts),
+                callback=_result_callback,
+                error_callback=_error_callback,
+            )
+        pool.close()
+        pool.join()
 
-        fake_date += timedelta(minutes=1)
+    progress_bar.close()
+    return errors
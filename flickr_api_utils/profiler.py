@@ -0,0 +1,92 @@
+from collections import Counter
+import logging
+import os
+import sys
+import threading
+
+from .worker_pool import register_worker_collector
+
+logger = logging.getLogger(__name__)
+
+# seconds
+SAMPLE_INTERVAL = 0.005
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)})"
+
+
+class SamplingProfiler:
+    """Samples the stacks of all the threads of the process at a fixed interval
+
+    Output is in the folded format (one line by stack with ; between the frames and
+    the number of samples) read by flamegraph.pl, speedscope or inferno.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def folded(self, root):
+        return [f"{root};{stack} {count}" for stack, count in self.counts.items()]
+
+
+# main process (and each pool worker its own)
+_profiler = None
+# main process: merges the folded stacks of the pool workers
+_merge_workers = None
+_worker_lines = []
+
+
+def enable():
+    global _profiler, _merge_workers
+    _profiler = SamplingProfiler()
+    _profiler.start()
+    _merge_workers = register_worker_collector(
+        "profile", _worker_folded, _worker_lines.extend, setup=_init_worker
+    )
+
+
+def _init_worker():
+    global _profiler
+    _profiler = SamplingProfiler()
+    _profiler.start()
+
+
+def _worker_folded():
+    _profiler.stop()
+    return _profiler.folded(f"worker-{os.getpid()}")
+
+
+def write_report(path):
+    """Write the folded stacks of the main process and the pool workers"""
+    _profiler.stop()
+    _merge_workers()
+    lines = _profiler.folded("main") + _worker_lines
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    logger.info(f"Profile written to {path} (folded stacks for flamegraph.pl)")
@@ -0,0 +1,164 @@
+from enum import Enum, auto
+from functools import partial
+import logging
+import re
+from time import sleep
+
+from flickrapi.exceptions import FlickrError
+import requests
+
+from .metrics import metrics
+from .trace import tracer
+
+logger = logging.getLogger(__name__)
+
+# seconds
+API_RETRY_DELAY = 5
+
+PRINT_API_ERROR = False
+
+
+class RetryAction(Enum):
+    RETRY = auto()
+    # error means the call is useless (e.g. photo already in set): return None
+    SKIP = auto()
+    ABORT = auto()
+
+
+# sending them again after an error may do the operation twice: new photo or album
+NON_IDEMPOTENT_METHODS = {
+    "upload",
+    "flickr.photosets.create",
+}
+
+# Flickr error codes common to all methods
+GLOBAL_ERROR_ACTIONS = {
+    # Service currently unavailable
+    105: RetryAction.RETRY,
+    # Write operation failed
+    106: RetryAction.RETRY,
+}
+
+# flickrapi raises a FlickrError without code for HTTP errors
+HTTP_STATUS_REGEX = re.compile(r"Status code (\d+) received")
+
+# error codes specific to a method (codes < 96 are method specific)
+METHOD_ERROR_ACTIONS = {
+    "flickr.photosets.addPhoto": {
+        # Photo already in set: usually a 500 error was received the first time but
+        # the photo was actually added
+        3: RetryAction.SKIP,
+    },
+    "upload": {
+        # General upload failure
+        3: RetryAction.RETRY,
+    },
+    "replace": {
+        # General upload failure
+        3: RetryAction.RETRY,
+    },
+}
+
+
+def method_name(func):
+    """Flickr method called by func (None if not known)
+
+    Works for flickr.<method> (also wrapped in partials), flickr.upload and
+    flickr.replace.
+    """
+    while isinstance(func, partial):
+        func = func.func
+    name = getattr(func, "method_name", None)
+    if name:
+        return name
+    name = getattr(func, "__name__", None)
+    if name in ("upload", "replace"):
+        return name
+    return None
+
+
+def is_idempotent(method):
+    return method not in NON_IDEMPOTENT_METHODS
+
+
+def classify_error(method, ex):
+    if not isinstance(ex, FlickrError):
+        # network errors mostly (timeouts, connection reset)
+        return RetryAction.RETRY
+
+    if ex.code is None:
+        m = HTTP_STATUS_REGEX.search(str(ex))
+        if m and 400 <= int(m.group(1)) < 500 and int(m.group(1)) != 429:
+            # request rejected: same result if sent again
+            return RetryAction.ABORT
+        # HTTP status error (500, 504...) returned by the Flickr servers
+        return RetryAction.RETRY
+
+    action = METHOD_ERROR_ACTIONS.get(method, {}).get(ex.code)
+    if action:
+        return action
+
+    action = GLOBAL_ERROR_ACTIONS.get(ex.code)
+    if action:
+        return action
+
+    # invalid parameters, signature, permissions, API key, not found... : same result
+    # if sent again
+    return RetryAction.ABORT
+
+
+def may_have_been_processed(ex):
+    """True if the request may have reached Flickr and been processed despite ex"""
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        # never connected
+        return False
+    if isinstance(ex, requests.exceptions.RequestException):
+        # read timeout, connection reset after sending...
+        return True
+    if isinstance(ex, FlickrError) and ex.code is None:
+        # HTTP error status: seen with photos uploaded anyway
+        return True
+    return False
+
+
+def retry(num_retries, func, method=None, check_sent=None):
+    """Call func, retrying if the error is classified as temporary
+
+    method: Flickr method called by func, to classify the errors (guessed from func if
+    not passed).
+    check_sent: for non-idempotent methods, called before sending the request again
+    if the previous one may have been processed anyway: if it returns something else
+    than None, the call is considered done and that value is returned.
+    """
+    method = method or method_name(func)
+    retry = num_retries
+    while True:
+        try:
+            return func()
+        except Exception as ex:
+            action = classify_error(method, ex)
+            # TODO see if formatting problem with progress bar
+            if PRINT_API_ERROR:
+                logger.warning(f"Error calling Flickr API ({method}): {ex} [{action}]")
+            if action == RetryAction.SKIP:
+                return None
+            if action == RetryAction.ABORT:
+                raise
+
+            retry -= 1
+            if retry <= 0:
+                raise
+            metrics.record_retry(method)
+            with tracer.span("retry sleep", "retry", method=method, error=str(ex)):
+                sleep(API_RETRY_DELAY)
+
+            if check_sent and not is_idempotent(method) and may_have_been_processed(ex):
+                try:
+                    result = check_sent()
+                except Exception as check_ex:
+                    # unknown: sent again (may duplicate but not lost)
+                    logger.warning(f"{method}: unable to check if sent: {check_ex}")
+                    result = None
+                if result is not None:
+                    logger.debug(f"{method}: already processed. No retry")
+                    return result
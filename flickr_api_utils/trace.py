@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+from .worker_pool import register_worker_collector
+
+logger = logging.getLogger(__name__)
+
+
+def _now_us():
+    # monotonic clock: same origin in all the processes (pool workers)
+    return time.monotonic_ns() // 1000
+
+
+class Tracer:
+    """Spans recorded as Chrome trace events (chrome://tracing, Perfetto)
+
+    One lane by process and thread. Thread-safe. Nothing is recorded unless enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        # new lock: a forked worker can get a copy of a lock held by another thread
+        self._lock = threading.Lock()
+        self.events = []
+        self._thread_names = {}
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            yield
+            return
+        start = _now_us()
+        try:
+            yield
+        finally:
+            thread = threading.current_thread()
+            event = dict(
+                name=name,
+                cat=cat,
+                ph="X",
+                ts=start,
+                dur=_now_us() - start,
+                pid=os.getpid(),
+                tid=thread.native_id,
+            )
+            if args:
+                event["args"] = args
+            with self._lock:
+                self.events.append(event)
+                self._thread_names[thread.native_id] = thread.name
+
+    def metadata(self, process_name):
+        pid = os.getpid()
+        events = [
+            dict(name="process_name", ph="M", pid=pid, args=dict(name=process_name))
+        ]
+        for tid, name in self._thread_names.items():
+            events.append(
+                dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=name))
+            )
+        return events
+
+
+tracer = Tracer()
+
+# main process: merges the events of the pool workers
+_merge_workers = None
+
+
+def enable():
+    global _merge_workers
+    tracer.enabled = True
+    _merge_workers = register_worker_collector(
+        "trace", _worker_events, _merge_events, setup=_init_worker
+    )
+
+
+def _init_worker():
+    # forked workers have a copy of the main process events
+    tracer.reset()
+    tracer.enabled = True
+
+
+def _worker_events():
+    return tracer.events + tracer.metadata(f"worker {os.getpid()}")
+
+
+def _merge_events(events):
+    tracer.events.extend(events)
+
+
+def write_report(path):
+    """Write the events of the main process and the pool workers"""
+    _merge_workers()
+    events = tracer.events + tracer.metadata("main")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+    logger.info(f"Trace written to {path} (chrome://tracing or ui.perfetto.dev)")
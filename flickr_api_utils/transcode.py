@@ -0,0 +1,48 @@
+from io import BytesIO
+import logging
+import os
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# when only resizing
+DEFAULT_QUALITY = 90
+MIN_QUALITY = 1
+MAX_QUALITY = 95
+
+
+def transcode(filepath, max_size=None, quality=None):
+    """JPEG bytes of the photo resized and / or recompressed or None if not smaller
+
+    max_size: max length of the long edge in pixels (not enlarged)
+    quality: JPEG quality (default 90 if only resized)
+
+    EXIF, XMP and ICC profile of the original are kept. Only JPEG files are
+    transcoded: None for other formats.
+    """
+    with Image.open(filepath) as im:
+        if im.format != "JPEG":
+            return None
+        info = im.info
+        if max_size and max(im.size) > max_size:
+            # uses the JPEG draft mode: decoded at a reduced scale so faster
+            im.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        elif not quality:
+            return None
+
+        buffer = BytesIO()
+        im.save(
+            buffer,
+            "JPEG",
+            quality=quality or DEFAULT_QUALITY,
+            exif=info.get("exif", b""),
+            xmp=info.get("xmp", b""),
+            icc_profile=info.get("icc_profile"),
+        )
+
+    data = buffer.getvalue()
+    if len(data) >= os.path.getsize(filepath):
+        logger.debug(f"{filepath}: transcoded not smaller, original is uploaded")
+        return None
+    return data
@@ -1,26 +1,59 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from datetime import datetime
-from enum import Enum, auto
 from functools import partial
+import glob
 import logging
-from multiprocessing import Pool
+from multiprocessing import Value
 from operator import attrgetter
 import os
 from pathlib import Path
-import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
 from time import sleep
 
 from addict import Dict as Addict
 from attrs import define
 import click
 import flickrapi
-import piexif
 from tqdm import tqdm
 
+from . import bandwidth
 from .api_auth import auth_flickr
+from .archive_utils import move_tree
 from .base import CatchAllExceptionsCommand
-from .flickr_utils import format_tags, get_photos, get_photostream_photos
+from .exif_utils import read_date_taken, read_gps
+from .flickr_utils import (
+    API_RETRIES,
+    MAX_PER_PAGE,
+    NCOLS,
+    PhotoRecord,
+    PhotoTicketStatus,
+    TicketStatusEnum,
+    UploadError,
+    check_tickets,
+    format_tags,
+    get_photos,
+    get_photostream_photos,
+    to_flickr_date,
+)
+from .folder_watch import FolderWatcher
+from .metrics import metrics
+from .retry_policy import retry
+from .trace import tracer
+from .transcode import DEFAULT_QUALITY, MAX_QUALITY, MIN_QUALITY, transcode
+from .upload_stream import ProgressFile, ProgressPoller
+from .upload_tuning import (
+    DEFAULT_CONCURRENCY,
+    ConcurrencyTuner,
+    load_concurrency,
+    network_key,
+    save_concurrency,
+)
 from .url_utils import extract_album_id
+from .worker_pool import Pool
 from .xmp_utils import (
     NoXMPPacketFound,
     extract_xmp,
@@ -31,24 +64,26 @@ from .xmp_utils import (
     parse_xmp,
 )
 
-API_RETRIES = 6
-API_RETRY_DELAY = 5
-
-UPLOAD_CONCURRENCY = 2
+# Flickr API calls (setting public)
+API_CONCURRENCY = 4
 QUICK_CONCURRENCY = 1
 
-NCOLS = 80
-
 BASE_PHOTO_DIR = "/Volumes/CrucialX8/photos/"
 UPLOADED_DIR = "____uploaded"
 ZOOM_DIR = "tz95"
 ZOOM_PREFIX = "P"
+ARCHIVE_LOG = "archive.log"
+
+# upload watch: seconds
+WATCH_INTERVAL = 5
+WATCH_ALBUM_INTERVAL = 60
+WATCH_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
-PRINT_API_ERROR = False
+# upload batch: FOLDER=id:<album ID>
+BATCH_ALBUM_ID_PREFIX = "id:"
 
-# seconds
-CHECK_TICKETS_SLEEP = 3
-MAX_NUM_CHECKS = 10
+# margin if the time in Flickr is different from local
+UPLOAD_SEARCH_MARGIN = 10
 
 logger = logging.getLogger(__name__)
 
@@ -58,14 +93,13 @@ flickrapi.set_log_level(logging.CRITICAL)
 logging.getLogger("flickrapi.auth.OAuthTokenHTTPServer").disabled = True
 logging.getLogger("flickrapi.auth.OAuthFlickrInterface").disabled = True
 
-PhotoTicketStatus = namedtuple("PhotoTicketStatus", "status photo_id filepath order")
 
-
-class ValidationError(Exception):
-    pass
+# returned by the retry of an upload instead of the response if the photo is found
+# in the photostream (the previous attempt was processed despite the error)
+AlreadyUploaded = namedtuple("AlreadyUploaded", "photo_id")
 
 
-class UploadError(Exception):
+class ValidationError(Exception):
     pass
 
 
@@ -77,12 +111,6 @@ class AddToAlbumError(Exception):
     pass
 
 
-class TicketStatusEnum(Enum):
-    INCOMPLETE = auto()
-    COMPLETE = auto()
-    INVALID = auto()
-
-
 @define
 class UploadOptions:
     is_public: bool = False
@@ -90,6 +118,9 @@ class UploadOptions:
     is_create_album: bool = False
     album_name: str = None
     album_description: str = None
+    # transcoding before upload: max long edge in pixels, JPEG quality
+    max_size: int = None
+    quality: int = None
 
 
 def is_filtered(xmp_root, filter_label):
@@ -177,8 +208,33 @@ archive_option = click.option(
 
 parallel_option = click.option(
     "--parallel",
-    default=UPLOAD_CONCURRENCY,
-    help="Set number of parallel uploads + Flickr API calls",
+    type=int,
+    default=None,
+    help="Set number of parallel uploads (default: autotuned for the current "
+    "network, starting from the last tuned value)",
+)
+
+max_size_option = click.option(
+    "--max-size",
+    "max_size",
+    type=click.IntRange(min=1),
+    help="Downscale JPEG files to this max long edge (in pixels) before upload",
+    envvar="FAU_MAX_SIZE",
+)
+
+quality_option = click.option(
+    "--quality",
+    "quality",
+    type=click.IntRange(MIN_QUALITY, MAX_QUALITY),
+    help="Recompress JPEG files at this quality before upload (default: "
+    f"{DEFAULT_QUALITY} if downscaled)",
+    envvar="FAU_QUALITY",
+)
+
+api_parallel_option = click.option(
+    "--api-parallel",
+    default=API_CONCURRENCY,
+    help="Set number of parallel Flickr API calls",
 )
 
 
@@ -196,11 +252,21 @@ def upload():
 @album_name_option
 @album_description_option
 @parallel_option
+@api_parallel_option
+@max_size_option
+@quality_option
 @yes_option
 @abort_no_metadata_option
 @archive_option
 def complete(
-    folder, filter_label, is_yes, parallel, is_abort_no_metadata, is_archive, **kwargs
+    folder,
+    filter_label,
+    is_yes,
+    parallel,
+    api_parallel,
+    is_abort_no_metadata,
+    is_archive,
+    **kwargs,
 ):
     flickr = auth_flickr()
 
@@ -214,26 +280,12 @@ def complete(
 
     logger.info(f"{len(files_to_upload)} files to upload")
 
-    empty_metadata = []
-    for file_path, xmp_root in files_to_upload:
-        title = get_title(xmp_root)
-        tags = get_tags(xmp_root)
-
-        if not title or not tags:
-            empty_metadata.append(file_path)
-
-    if empty_metadata:
-        no_metadata = ", ".join(os.path.basename(f) for f in empty_metadata)
-        logger.info(f"Files without metadata: {no_metadata}")
-        if is_abort_no_metadata:
-            logger.error("Some files have no metadata. Abort!")
-            return
+    if _has_empty_metadata(files_to_upload) and is_abort_no_metadata:
+        logger.error("Some files have no metadata. Abort!")
+        return
 
     _print_album_options(flickr, upload_options)
-    if upload_options.is_public:
-        logger.info("Will make photos public")
-    else:
-        logger.info("Will keep photos private")
+    _print_upload_options(upload_options)
 
     if is_archive:
         logger.info("Will move to archive")
@@ -248,24 +300,473 @@ def complete(
 
     files_to_upload = order_by_date(files_to_upload)
 
-    photo_uploaded_ids = _upload_photos(
+    uploaded_photos, _ = _upload_photos(
         flickr, now_ts, upload_options, files_to_upload, parallel
     )
-    if not photo_uploaded_ids:
+    if not uploaded_photos:
         logger.error("No files were succesfully uploaded. Abort!")
         return
+    photo_uploaded_ids = [p.id for p in uploaded_photos]
 
     _set_date_posted(flickr, now_ts, photo_uploaded_ids, QUICK_CONCURRENCY)
     if upload_options.is_public:
-        _set_public(flickr, now_ts, photo_uploaded_ids, parallel)
-    _add_to_album(flickr, upload_options, photo_uploaded_ids, QUICK_CONCURRENCY)
+        _set_public(flickr, now_ts, photo_uploaded_ids, api_parallel)
+    _add_to_album(flickr, upload_options, uploaded_photos, QUICK_CONCURRENCY)
 
     if is_archive:
-        _copy_to_uploaded(folder)
+        _archive_in_background(folder)
+
+    logger.info("End!")
+
+
+@define
+class BatchItem:
+    """Folders of a batch upload spec going to the same album"""
+
+    spec: str
+    folders: list
+    upload_options: UploadOptions
+    files_to_upload: list = None
+
+
+@upload.command("batch", cls=CatchAllExceptionsCommand)
+@click.argument("specs", nargs=-1, required=True, metavar="FOLDER[=ALBUM]...")
+@click.option("--label", "filter_label", default="Accepted", help="Label to filter on")
+@public_option
+@parallel_option
+@api_parallel_option
+@max_size_option
+@quality_option
+@yes_option
+@abort_no_metadata_option
+@archive_option
+def batch(
+    specs,
+    filter_label,
+    is_yes,
+    parallel,
+    api_parallel,
+    is_abort_no_metadata,
+    is_archive,
+    **kwargs,
+):
+    """Upload several folders through the same upload pool
+
+    FOLDER can be a glob and is relative to the base photo folder if not found
+    from the current directory. ALBUM is the name of an album to create (or reuse if
+    it exists), or id:<album ID> or an album URL to add to. Without ALBUM, the photos
+    are not added to an album. The folders of the specs with the same ALBUM go to the
+    same album.
+    """
+    flickr = auth_flickr()
+
+    # transcoding and public: same for all the folders
+    upload_options = UploadOptions(**kwargs)
+
+    items = [_parse_batch_spec(spec) for spec in specs]
+    _check_unique_folders(items)
+    items = _group_by_album(items)
+
+    logger.info("Getting files to upload ...")
+    for item in items:
+        item.upload_options = _prepare_upload_options(flickr, item.upload_options)
+        item.files_to_upload = [
+            file for folder in item.folders for file in filtered(folder, filter_label)
+        ]
+    items = [item for item in items if item.files_to_upload]
+    if not items:
+        logger.error("No files to upload. Abort!")
+        return
+
+    files_to_upload = [file for item in items for file in item.files_to_upload]
+    if _has_empty_metadata(files_to_upload) and is_abort_no_metadata:
+        logger.error("Some files have no metadata. Abort!")
+        return
+
+    for item in items:
+        folders = ", ".join(item.folders)
+        logger.info(f"'{item.spec}': {len(item.files_to_upload)} files in {folders}")
+        _print_album_options(flickr, item.upload_options)
+    logger.info(f"{len(files_to_upload)} files to upload")
+    _print_upload_options(upload_options)
+
+    if is_archive:
+        logger.info("Will move to archive")
+
+    if not is_yes:
+        if not click.confirm("The images will be uploaded. Confirm?"):
+            logger.warning("Aborted by user")
+            exit(1)
+
+    now_ts = int(datetime.now().timestamp())
+
+    # one pool for all the folders: dates posted follow the date taken over the batch
+    files_to_upload = order_by_date(files_to_upload)
+    uploaded_photos, filepath_by_id = _upload_photos(
+        flickr, now_ts, upload_options, files_to_upload, parallel
+    )
+    if not uploaded_photos:
+        logger.error("No files were succesfully uploaded. Abort!")
+        return
+    photo_uploaded_ids = [p.id for p in uploaded_photos]
+
+    _set_date_posted(flickr, now_ts, photo_uploaded_ids, QUICK_CONCURRENCY)
+    if upload_options.is_public:
+        _set_public(flickr, now_ts, photo_uploaded_ids, api_parallel)
+    for item, photos in _split_by_item(items, uploaded_photos, filepath_by_id):
+        if photos:
+            _add_to_album(flickr, item.upload_options, photos, QUICK_CONCURRENCY)
+        else:
+            logger.warning(f"'{item.spec}': no photo uploaded, album not updated")
+
+    if is_archive:
+        # the archive moves the folder above (can be shared)
+        archived = set()
+        for item in items:
+            for folder in item.folders:
+                super_folder = os.path.dirname(os.path.abspath(folder))
+                if super_folder not in archived:
+                    archived.add(super_folder)
+                    _archive_in_background(folder)
+
+    logger.info("End!")
+
+
+def _parse_batch_spec(spec):
+    pattern, _, album = spec.partition("=")
+    pattern = pattern.strip()
+    if not os.path.isabs(pattern) and not glob.glob(pattern):
+        pattern = os.path.join(BASE_PHOTO_DIR, pattern)
+    folders = sorted(
+        folder
+        for folder in map(_norm_folder, glob.glob(pattern))
+        if os.path.isdir(folder)
+    )
+    if not folders:
+        raise ValidationError(f"No folder found for '{spec}'")
+
+    upload_options = UploadOptions()
+    album = album.strip()
+    if album.startswith(BATCH_ALBUM_ID_PREFIX):
+        # explicit: an album name can be a number
+        album_id = album[len(BATCH_ALBUM_ID_PREFIX) :].strip()
+        try:
+            upload_options.album_id = extract_album_id(album_id)
+        except ValueError as ex:
+            raise ValidationError(f"Invalid album ID in '{spec}'") from ex
+    elif "flickr.com/" in album:
+        # album URL
+        upload_options.album_id = extract_album_id(album)
+    elif album:
+        upload_options.is_create_album = True
+        upload_options.album_name = album
+    return BatchItem(spec, folders, upload_options)
+
+
+def _group_by_album(items):
+    """Items merged if they go to the same album (ID or name of an album to create)
+
+    So an album to create is created once for all the specs.
+    """
+    grouped = []
+    item_by_album = {}
+    for item in items:
+        options = item.upload_options
+        album_key = options.album_id or options.album_name
+        if album_key is None:
+            grouped.append(item)
+            continue
+        if album_key in item_by_album:
+            group = item_by_album[album_key]
+            group.spec += f", {item.spec}"
+            group.folders.extend(item.folders)
+            continue
+        item_by_album[album_key] = item
+        grouped.append(item)
+    return grouped
+
+
+def _check_unique_folders(items):
+    seen = set()
+    for item in items:
+        for folder in item.folders:
+            folder = os.path.realpath(folder)
+            if folder in seen:
+                raise ValidationError(f"Folder {folder} is in several specs")
+            seen.add(folder)
+
+
+def _split_by_item(items, uploaded_photos, filepath_by_id):
+    """[(item, photos)]: uploaded photos matched to the batch items by file path"""
+    item_by_filepath = {}
+    for item in items:
+        for filepath, _ in item.files_to_upload:
+            item_by_filepath[filepath] = item
+
+    photos_by_item = {id(item): [] for item in items}
+    for photo in uploaded_photos:
+        item = item_by_filepath.get(filepath_by_id.get(photo.id))
+        if item is None:
+            logger.warning(f"Photo {photo.id} not matched to a file (no album)")
+            continue
+        photos_by_item[id(item)].append(photo)
+    return [(item, photos_by_item[id(item)]) for item in items]
+
+
+def _has_empty_metadata(files_to_upload):
+    empty_metadata = []
+    for file_path, xmp_root in files_to_upload:
+        title = get_title(xmp_root)
+        tags = get_tags(xmp_root)
+
+        if not title or not tags:
+            empty_metadata.append(file_path)
+
+    if empty_metadata:
+        no_metadata = ", ".join(os.path.basename(f) for f in empty_metadata)
+        logger.info(f"Files without metadata: {no_metadata}")
+    return bool(empty_metadata)
+
+
+def _print_upload_options(upload_options):
+    if upload_options.is_public:
+        logger.info("Will make photos public")
+    else:
+        logger.info("Will keep photos private")
+
+    if upload_options.max_size or upload_options.quality:
+        logger.info(
+            f"Will transcode JPEG files (max size: {upload_options.max_size}, "
+            f"quality: {upload_options.quality or DEFAULT_QUALITY})"
+        )
+
+
+@upload.command("watch", cls=CatchAllExceptionsCommand)
+@folder_option
+@click.option("--label", "filter_label", default="Accepted", help="Label to filter on")
+@public_option
+@album_option
+@create_album_option
+@album_name_option
+@album_description_option
+@parallel_option
+@max_size_option
+@quality_option
+@click.option(
+    "--interval",
+    type=float,
+    default=WATCH_INTERVAL,
+    help="Seconds between scans of the folder",
+)
+@click.option(
+    "--album-interval",
+    type=float,
+    default=WATCH_ALBUM_INTERVAL,
+    help="Seconds between updates of the dates, permissions and album for the "
+    "photos uploaded",
+)
+@click.option(
+    "--skip-existing",
+    "is_skip_existing",
+    is_flag=True,
+    help="Only upload files modified after the start",
+)
+@click.option(
+    "--wait-md/--no-wait-md",
+    "is_wait_metadata",
+    default=True,
+    help="Wait for files to have metadata (title and tags) before uploading them",
+)
+def watch(
+    folder,
+    filter_label,
+    parallel,
+    interval,
+    album_interval,
+    is_skip_existing,
+    is_wait_metadata,
+    **kwargs,
+):
+    """Upload the files of a folder as they get the label (until Ctrl-C)
+
+    The folder is scanned for files modified (like relabelled in Bridge). The
+    uploaded photos are added to the album and reordered by batch.
+    """
+    flickr = auth_flickr()
+
+    upload_options = _prepare_upload_options(flickr, UploadOptions(**kwargs))
+    _print_album_options(flickr, upload_options)
+    _print_upload_options(upload_options)
+
+    if not parallel:
+        # no autotuning: the uploads come one by one
+        parallel = load_concurrency(network_key()) or DEFAULT_CONCURRENCY
+
+    watcher = FolderWatcher(folder, WATCH_EXTENSIONS, is_skip_existing)
+    # paths uploaded or being uploaded: not uploaded again if modified
+    submitted = set()
+    # results of upload_to_flickr: processed by batch
+    uploaded = []
+    uploaded_lock = threading.Lock()
+
+    def _result_callback(result):
+        logger.info(f"Uploaded {os.path.basename(result[2])}")
+        with uploaded_lock:
+            uploaded.append(result)
+
+    def _error_callback(filepath, ex):
+        logger.error(f"{ex.args[0]} (modify the file to try again)")
+        submitted.discard(filepath)
+
+    logger.info(
+        f"Watching '{folder}' for files labelled '{filter_label}' (Ctrl-C to stop) ..."
+    )
+    pool = Pool(parallel, initializer=_init_watch_worker)
+    last_update = time.monotonic()
+    try:
+        while True:
+            for filepath in watcher.poll():
+                if filepath in submitted:
+                    logger.debug(f"{filepath} already uploaded: changes ignored")
+                    continue
+                xmp_root = _read_watched(filepath, filter_label, is_wait_metadata)
+                if xmp_root is None:
+                    continue
+                logger.info(f"Uploading {os.path.basename(filepath)} ...")
+                submitted.add(filepath)
+                pool.apply_async(
+                    upload_to_flickr,
+                    (flickr, upload_options, len(submitted), filepath, xmp_root),
+                    callback=_result_callback,
+                    error_callback=partial(_error_callback, filepath),
+                )
 
+            if time.monotonic() - last_update >= album_interval:
+                try:
+                    _update_watched(
+                        flickr, upload_options, uploaded, uploaded_lock, submitted
+                    )
+                except Exception as ex:
+                    # still in uploaded: done again at the next update
+                    logger.error(f"Unable to update the photos uploaded: {ex}")
+                last_update = time.monotonic()
+            sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("Stopping: waiting for the uploads in progress ...")
+    finally:
+        pool.close()
+        pool.join()
+
+    try:
+        _update_watched(flickr, upload_options, uploaded, uploaded_lock, submitted)
+    except Exception as ex:
+        logger.error(
+            f"Unable to update the photos uploaded: {ex} (run 'upload finish --last "
+            f"{len(uploaded)}' with the same album options)"
+        )
     logger.info("End!")
 
 
+def _init_watch_worker():
+    # Ctrl-C stops the watch in the main process: the uploads in progress finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_upload_worker(None, None)
+
+
+def _read_watched(filepath, filter_label, is_wait_metadata):
+    """XMP of the file if it is to upload or None"""
+    try:
+        xmp_root = parse_xmp(extract_xmp(filepath))
+    except NoXMPPacketFound:
+        return None
+    except Exception as ex:
+        # checked again at the next change
+        logger.warning(f"Unable to read the XMP of {filepath}: {ex}")
+        return None
+
+    if not is_filtered(xmp_root, filter_label):
+        return None
+    if is_wait_metadata and not (get_title(xmp_root) and get_tags(xmp_root)):
+        logger.info(f"{os.path.basename(filepath)} has no metadata: not uploaded yet")
+        return None
+    # needed for the dates and the album order
+    try:
+        date_taken = read_date_taken(filepath)
+    except Exception as ex:
+        logger.warning(f"Unable to read the EXIF of {filepath}: {ex}")
+        return None
+    if not date_taken:
+        logger.warning(
+            f"{os.path.basename(filepath)} has no EXIF date taken: not uploaded "
+            "(modify the file to try again)"
+        )
+        return None
+    return xmp_root
+
+
+def _update_watched(flickr, upload_options, uploaded, uploaded_lock, submitted):
+    """Set dates, permissions and album for the photos uploaded since the last time
+
+    upload_options is updated with the album ID once created. The files rejected by
+    Flickr are removed from submitted, so uploaded again if modified.
+    """
+    with uploaded_lock:
+        results = list(uploaded)
+    if not results:
+        return
+
+    photo_status = {}
+    for order, ticket_id, filepath, photo_id in results:
+        if photo_id:
+            photo_status[f"found-{photo_id}"] = PhotoTicketStatus(
+                TicketStatusEnum.COMPLETE, photo_id, filepath, order
+            )
+        else:
+            photo_status[ticket_id] = PhotoTicketStatus(
+                TicketStatusEnum.INCOMPLETE, None, filepath, order
+            )
+    check_tickets(flickr, photo_status)
+
+    # date taken from the EXIF (same as Flickr): dates posted and album order
+    date_taken = {
+        s.filepath: date_taken_key((s.filepath, None)) for s in photo_status.values()
+    }
+    statuses = sorted(photo_status.values(), key=lambda s: date_taken[s.filepath])
+    # still incomplete: checked again next time
+    done_files = {
+        s.filepath for s in statuses if s.status != TicketStatusEnum.INCOMPLETE
+    }
+    for s in statuses:
+        if s.status == TicketStatusEnum.INVALID:
+            logger.error(
+                f"{os.path.basename(s.filepath)} rejected by Flickr (modify the file "
+                "to try again)"
+            )
+            submitted.discard(s.filepath)
+    uploaded_photos = [
+        PhotoRecord(id=s.photo_id, datetaken=to_flickr_date(date_taken[s.filepath]))
+        for s in statuses
+        if s.status == TicketStatusEnum.COMPLETE
+    ]
+
+    if uploaded_photos:
+        now_ts = int(datetime.now().timestamp())
+        photo_ids = [p.id for p in uploaded_photos]
+        _set_date_posted(flickr, now_ts, photo_ids, QUICK_CONCURRENCY)
+        if upload_options.is_public:
+            _set_public(flickr, now_ts, photo_ids, QUICK_CONCURRENCY)
+        album_id = _add_to_album(
+            flickr, upload_options, uploaded_photos, QUICK_CONCURRENCY
+        )
+        if album_id and upload_options.is_create_album:
+            # created: next photos added to it
+            upload_options.album_id = album_id
+            upload_options.is_create_album = False
+
+    with uploaded_lock:
+        uploaded[:] = [result for result in uploaded if result[2] not in done_files]
+
+
 @upload.command("archive", cls=CatchAllExceptionsCommand)
 @folder_option
 def archive(folder):
@@ -280,9 +781,9 @@ def archive(folder):
 @create_album_option
 @album_name_option
 @album_description_option
-@parallel_option
+@api_parallel_option
 @archive_option
-def finish_started(folder, last_photos_num, parallel, is_archive, **kwargs):
+def finish_started(folder, last_photos_num, api_parallel, is_archive, **kwargs):
     flickr = auth_flickr()
 
     upload_options = _prepare_upload_options(flickr, UploadOptions(**kwargs))
@@ -296,8 +797,8 @@ def finish_started(folder, last_photos_num, parallel, is_archive, **kwargs):
 
     _set_date_posted(flickr, now_ts, photo_uploaded_ids, QUICK_CONCURRENCY)
     if upload_options.is_public:
-        _set_public(flickr, now_ts, photo_uploaded_ids, parallel)
-    _add_to_album(flickr, upload_options, photo_uploaded_ids, QUICK_CONCURRENCY)
+        _set_public(flickr, now_ts, photo_uploaded_ids, api_parallel)
+    _add_to_album(flickr, upload_options, photos, QUICK_CONCURRENCY)
 
     if is_archive:
         _copy_to_uploaded(folder)
@@ -314,6 +815,7 @@ def _copy_to_uploaded(folder):
     # assumes already exists
     if not os.path.exists(to_dir) or not os.path.isdir(to_dir):
         logger.info(f"Path {to_dir} doesn't exist or is not a dir. Abort archiving!")
+        return
 
     # assume is 2012313-.../xs20 => so 2 parts above base_photo_dir
     relpath = os.path.relpath(folder, BASE_PHOTO_DIR)
@@ -329,22 +831,38 @@ def _copy_to_uploaded(folder):
         move_zoom_photos(super_folder, folder)
 
         logger.info(f"Archiving '{super_folder}' to '{to_dir}' ...")
-        shutil.move(super_folder, to_dir)
+        move_tree(super_folder, to_dir)
         logger.info("Successfully archived!")
     except Exception as e:
         logger.error(f"Error archiving '{super_folder}' to '{to_dir}': {e}")
 
 
+def _archive_in_background(folder):
+    # detached process so the upload command can return : output in a log file since
+    # the terminal may be gone by then
+    logger.info(f"Archiving in the background (log in '{ARCHIVE_LOG}') ...")
+    with open(ARCHIVE_LOG, "a", encoding="utf-8") as log_file:
+        cmd = [sys.executable, "-m", __package__, "upload", "archive"]
+        subprocess.Popen(
+            [*cmd, "--folder", folder],
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+
 def move_zoom_photos(super_folder, folder):
     logger.info(f"Moving zoom photos to '{ZOOM_DIR}' ...")
     has_moved = False
     zoom_dir = os.path.join(super_folder, ZOOM_DIR)
-    for item_name in os.listdir(folder):
-        source_item_path = os.path.join(folder, item_name)
-        if os.path.isfile(source_item_path) and item_name.startswith(ZOOM_PREFIX):
+    # same parent folder so same device : simple renames
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.startswith(ZOOM_PREFIX):
+            if not has_moved:
+                os.makedirs(zoom_dir, exist_ok=True)
             has_moved = True
-            dest_item_path = os.path.join(zoom_dir, item_name)
-            shutil.move(source_item_path, dest_item_path)
+            os.rename(entry.path, os.path.join(zoom_dir, entry.name))
     if has_moved:
         logger.info("Sucessfully moved")
     else:
@@ -352,92 +870,130 @@ def move_zoom_photos(super_folder, folder):
     return has_moved
 
 
+# bytes sent by all the upload workers (shared with the main process)
+_upload_progress = None
+_upload_saved = None
+
+
+def _init_upload_worker(progress, saved):
+    global _upload_progress, _upload_saved
+    _upload_progress = progress
+    _upload_saved = saved
+
+
+def _largest_first(sizes):
+    """Indices sorted by decreasing size (same size: original order)"""
+    return sorted(range(len(sizes)), key=lambda index: -sizes[index])
+
+
 def _upload_photos(
     flickr: flickrapi.FlickrAPI, now_ts, upload_options, files_to_upload, parallel
 ):
-    photos_uploaded = []
+    """Upload the files and wait for Flickr to process them
 
-    progress_bar = tqdm(desc="Uploading...", total=len(files_to_upload), ncols=NCOLS)
+    Returns the uploaded photos (sorted by date taken) and the file path by photo ID.
+    """
+    photos_uploaded = []
 
-    # result is tuple : index, photo_id, filepath, has_timeout
+    sizes = [os.path.getsize(filepath) for filepath, _ in files_to_upload]
+    # progress in bytes: updated while the files are sent
+    progress_bar = tqdm(
+        desc="Uploading...",
+        total=sum(sizes),
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        ncols=NCOLS,
+    )
+    bytes_sent = Value("q", 0)
+    # smaller files sent if transcoded
+    bytes_saved = Value("q", 0)
+
+    # number of uploads running is limited by the main process: the pool has the max
+    # so the concurrency can change during the upload
+    if not parallel and bandwidth.is_limited():
+        # the limit would be measured instead of the link: keep the tuned value
+        parallel = load_concurrency(network_key()) or DEFAULT_CONCURRENCY
+        logger.info(f"Bandwidth limited: {parallel} parallel uploads (no autotuning)")
+    if parallel:
+        tuner = None
+        max_parallel = parallel
+    else:
+        net_key = network_key()
+        start_parallel = load_concurrency(net_key) or DEFAULT_CONCURRENCY
+        logger.info(f"Autotuning parallel uploads (starting at {start_parallel})")
+        tuner = ConcurrencyTuner(start_parallel)
+        max_parallel = tuner.max_concurrency
+    in_flight = {}
+    in_flight_changed = threading.Condition()
+
+    def _done(index, is_error):
+        with in_flight_changed:
+            size = in_flight.pop(index)
+            if tuner and tuner.record(size, is_error):
+                progress_bar.write(f"Parallel uploads: {tuner.concurrency}")
+            in_flight_changed.notify()
+
+    # result is tuple : index, ticket_id, filepath, photo_id
     def _result_callback(result):
         photos_uploaded.append(result)
-        progress_bar.update(1)
+        _done(result[0], False)
 
-    def _error_callback(ex):
+    def _error_callback(index, ex):
         msg = "Error during 'Uploading photos': " + str(ex.args[0])
         progress_bar.write(msg)
-
-    with Pool(parallel) as pool:
-        for index, (filepath, xmp_root) in enumerate(files_to_upload):
+        _done(index, True)
+
+    with (
+        metrics.stage("upload"),
+        Pool(
+            max_parallel,
+            initializer=_init_upload_worker,
+            initargs=(bytes_sent, bytes_saved),
+        ) as pool,
+        ProgressPoller(bytes_sent, progress_bar, bytes_saved),
+    ):
+        # largest first (LPT): the small files keep the workers busy at the end
+        # instead of a big file sent alone. index is the rank in the date order: it
+        # is used for the dates posted and the album order
+        for index in _largest_first(sizes):
+            filepath, xmp_root = files_to_upload[index]
+            with in_flight_changed:
+                in_flight_changed.wait_for(
+                    lambda: len(in_flight) < (tuner.concurrency if tuner else parallel)
+                )
+                in_flight[index] = sizes[index]
             pool.apply_async(
                 upload_to_flickr,
                 (flickr, upload_options, index, filepath, xmp_root),
                 callback=_result_callback,
-                error_callback=_error_callback,
+                error_callback=partial(_error_callback, index),
             )
         pool.close()
         pool.join()
 
+    if tuner:
+        logger.info(f"Best parallel uploads: {tuner.best_concurrency}")
+        save_concurrency(net_key, tuner.best_concurrency)
+
     progress_bar.close()
 
     # all statuses are not known at the beginning
     # ticket_id: (status, photo_id, filepath, order)
     photo_status = {}
-    for order, ticket_id, filepath in photos_uploaded:
+    for order, ticket_id, filepath, photo_id in photos_uploaded:
+        if photo_id:
+            # already found in the photostream after an error
+            photo_status[f"found-{photo_id}"] = PhotoTicketStatus(
+                TicketStatusEnum.COMPLETE, photo_id, filepath, order
+            )
+            continue
         photo_status[ticket_id] = PhotoTicketStatus(
             TicketStatusEnum.INCOMPLETE, None, filepath, order
         )
 
-    num_checks = 0
     logger.info("Checking ticket statuses...")
-    while True:
-        tickets_to_check = [
-            ticket_id
-            for ticket_id, s in photo_status.items()
-            if s.status == TicketStatusEnum.INCOMPLETE
-        ]
-        if not tickets_to_check:
-            # all uploads failed ?
-            break
-
-        tickets_string = ",".join(tickets_to_check)
-        resp = flickr.photos.upload.checkTickets(tickets=tickets_string)
-        resp = Addict(resp)
-        ticket_statuses = resp.uploader.ticket
-        if not isinstance(ticket_statuses, list):
-            # if only 1 result, then is not a list
-            ticket_statuses = [ticket_statuses]
-
-        incomplete_photos = False
-        for status in ticket_statuses:
-            ticket_id = status.id
-            current_status = photo_status[ticket_id]
-
-            if status.complete == 0:
-                # not finished : do another pass for that ticket
-                incomplete_photos = True
-            elif status.complete == 1:
-                # OK
-                photo_id = status.photoid
-                photo_status[ticket_id] = current_status._replace(
-                    status=TicketStatusEnum.COMPLETE, photo_id=photo_id
-                )
-            elif status.complete == 2:
-                # invalid
-                photo_status[ticket_id] = current_status._replace(
-                    status=TicketStatusEnum.INVALID,
-                )
-            else:
-                logger.error(f"Unknown status {status.complete}")
-
-        if incomplete_photos:
-            num_checks += 1
-            if num_checks >= MAX_NUM_CHECKS:
-                break
-            sleep(CHECK_TICKETS_SLEEP)
-        else:
-            break
+    check_tickets(flickr, photo_status)
 
     # parallel upload may have changed the order : the last item of the tuple is
     # the rank in the original order
@@ -475,17 +1031,43 @@ def _upload_photos(
             )
             if not photos_indirect_not_found:
                 # after checking : photos that were incomplete are all uploaded
-                # but they may be missing tags or lat lon so reupload
-                _reupload_photos_without_tags(flickr, files_to_upload, photos)
-
-            photo_uploaded_ids = [s.id for s in photos]
+                # but they may be missing tags, title or lat lon
+                _repair_photos(flickr, files_to_upload, photos, API_CONCURRENCY)
+
+                filepath_by_id = {
+                    s.photo_id: s.filepath
+                    for s in sorted_statuses
+                    if s.status == TicketStatusEnum.COMPLETE
+                }
+                # the others: no photo ID from the ticket
+                other_photos = [p for p in photos if p.id not in filepath_by_id]
+                other_files = [
+                    file
+                    for file in files_to_upload
+                    if file[0] not in filepath_by_id.values()
+                ]
+                for photo, (filepath, _) in _match_by_date_taken(
+                    other_files, other_photos
+                ):
+                    filepath_by_id[photo.id] = filepath
+
+            uploaded_photos = photos
             not_all_photos_uploaded = photos_indirect_not_found
         else:
-            photo_uploaded_ids = [
-                s.photo_id
+            # date taken from the EXIF (same as Flickr) : used to insert in albums
+            uploaded_photos = [
+                PhotoRecord(
+                    id=s.photo_id,
+                    datetaken=to_flickr_date(date_taken_key((s.filepath, None))),
+                )
                 for s in sorted_statuses
                 if s.status == TicketStatusEnum.COMPLETE
             ]
+            filepath_by_id = {
+                s.photo_id: s.filepath
+                for s in sorted_statuses
+                if s.status == TicketStatusEnum.COMPLETE
+            }
     # else : we will abort anyway
 
     if not_all_photos_uploaded:
@@ -496,10 +1078,10 @@ def _upload_photos(
         )
         raise UploadError(msg)
 
-    if photo_uploaded_ids:
-        logger.info(f"{len(photo_uploaded_ids)} files uploaded")
+    if uploaded_photos:
+        logger.info(f"{len(uploaded_photos)} files uploaded")
 
-    return photo_uploaded_ids
+    return uploaded_photos, filepath_by_id
 
 
 def _norm_folder(folder):
@@ -513,59 +1095,203 @@ def _norm_folder(folder):
     return folder
 
 
-def _reupload_photos_without_tags(
-    flickr: flickrapi.FlickrAPI, files_to_upload, uploaded_photos
-):
-    logger.info("Replacing the incomplete photos (GPS, tags)...")
+@define
+class MetadataRepair:
+    """Fields to set on a photo uploaded with missing metadata"""
+
+    photo_id: str
+    filepath: str
+    # no original on Flickr: file sent again (before the other fields)
+    is_replace: bool = False
+    tags: list = None
+    title: str = None
+    # (latitude, longitude)
+    location: tuple = None
+
+
+@metrics.stage("metadata repair")
+def _repair_photos(flickr, files_to_upload, uploaded_photos, parallel):
+    """Set the title, tags and location missing on Flickr from the local files
+
+    For the uploads with a ticket not complete: Flickr may not have processed all
+    the metadata. The photos are matched to the files by date taken. The file is
+    only sent again if Flickr has no original.
+
+    uploaded_photos: need datetaken, title, tags, latitude, longitude and url_o
+    """
+    logger.info("Checking the metadata of the incomplete photos (title, tags, GPS)...")
+
+    repairs = []
+    for flickr_photo, (filepath, xmp_root) in _match_by_date_taken(
+        files_to_upload, uploaded_photos
+    ):
+        repair = _get_metadata_repair(flickr_photo, filepath, xmp_root)
+        if repair:
+            repairs.append(repair)
 
-    timeout = 30
-    num_retries = 3
-    # files to upload should correspod to uploaded_photos (verified before launching
-    # this)
-    for i in range(len(files_to_upload)):
-        try:
-            local_photo = files_to_upload[i]
-            flickr_photo = uploaded_photos[i]
+    if not repairs:
+        logger.info("No metadata missing")
+        return
 
-            if flickr_photo.tags:
-                continue
+    progress_bar = tqdm(desc="Repairing metadata...", total=len(repairs), ncols=NCOLS)
+
+    def _result_callback(result):
+        progress_bar.update(1)
+
+    def _error_callback(ex):
+        msg = "Error during 'Repairing metadata': " + str(ex.args[0])
+        progress_bar.write(msg)
+
+    with Pool(parallel) as pool:
+        for repair in repairs:
+            pool.apply_async(
+                repair_photo,
+                (flickr, repair),
+                callback=_result_callback,
+                error_callback=_error_callback,
+            )
+        pool.close()
+        pool.join()
+
+    progress_bar.close()
+
+
+def _match_by_date_taken(files_to_upload, uploaded_photos):
+    """[(flickr_photo, (filepath, xmp_root))]
 
-            # no tags : for my convention : all photos have tags so it means something
-            # went wrong in the upload
-            # TODO we could check from the xmp if no tag is fine or not ; check the lat
-            # lon so we know if there is some mismatch and missing data
-            # TODO would need to add extract of lat lon from EXIF
+    If several photos have the same date taken, they are matched by title. Photos
+    without a single match are left out.
+    """
+    files_by_date = defaultdict(list)
+    for filepath, xmp_root in files_to_upload:
+        date_taken = to_flickr_date(date_taken_key((filepath, xmp_root)))
+        files_by_date[date_taken].append((filepath, xmp_root))
+
+    photos_by_date = defaultdict(list)
+    for flickr_photo in uploaded_photos:
+        photos_by_date[flickr_photo.datetaken].append(flickr_photo)
+
+    matches = []
+    for date_taken, photos in photos_by_date.items():
+        files = files_by_date.get(date_taken, [])
+        if len(photos) == 1 and len(files) == 1:
+            matches.append((photos[0], files[0]))
+            continue
+        for flickr_photo in photos:
+            # without title, Flickr uses the file name
+            same_title = [
+                file
+                for file in files
+                if (get_title(file[1]) or Path(file[0]).stem) == flickr_photo.title
+            ]
+            if len(same_title) == 1:
+                matches.append((flickr_photo, same_title[0]))
+            else:
+                logger.warning(
+                    f"No single file for photo {flickr_photo.id} (date taken "
+                    f"{date_taken}): not checked"
+                )
+    return matches
+
+
+def _get_metadata_repair(flickr_photo, filepath, xmp_root):
+    """MetadataRepair with the fields different on Flickr or None if none"""
+    repair = MetadataRepair(flickr_photo.id, filepath)
+    is_needed = False
+
+    if not flickr_photo.url_o:
+        repair.is_replace = True
+        is_needed = True
+
+    # Flickr returns the tags normalized
+    flickr_tags = set((flickr_photo.tags or "").split())
+    tags = [tag for tag in get_tags(xmp_root) if _normalize_tag(tag) not in flickr_tags]
+    if tags:
+        repair.tags = tags
+        is_needed = True
+
+    title = get_title(xmp_root)
+    if title and title != flickr_photo.title:
+        repair.title = title
+        is_needed = True
+
+    location = read_gps(filepath)
+    # no location: 0 from the API
+    if location and not (
+        float(flickr_photo.latitude or 0) or float(flickr_photo.longitude or 0)
+    ):
+        repair.location = location
+        is_needed = True
+
+    return repair if is_needed else None
+
+
+def _normalize_tag(tag):
+    # like Flickr in the tags returned by the API
+    return "".join(c for c in tag.lower() if c.isalnum())
+
+
+def repair_photo(flickr, repair: MetadataRepair):
+    timeout = 30
+    photo_id = repair.photo_id
+    try:
+        if repair.is_replace:
+
+            def replace():
+                with ProgressFile(repair.filepath) as fileobj:
+                    # etree: a failure from Flickr is raised when parsing
+                    return flickr.replace(
+                        repair.filepath,
+                        photo_id,
+                        fileobj=fileobj,
+                        format="etree",
+                        timeout=timeout,
+                    )
 
-            (filepath, xmp_root) = local_photo
-            # we will reset tags explcitly : title was already fine. latlon will be
-            # extracted from the photo
-            tags = get_tags(xmp_root)
-            flickr_tags = format_tags(tags)
-            # no description like the normal upload
+            retry(API_RETRIES, replace, method="replace")
 
+        if repair.tags:
             retry(
-                num_retries,
+                API_RETRIES,
                 partial(
-                    flickr.replace,
-                    filepath,
-                    flickr_photo.id,
-                    format="rest",
+                    flickr.photos.addTags,
+                    photo_id=photo_id,
+                    tags=format_tags(repair.tags),
                     timeout=timeout,
                 ),
             )
 
+        if repair.title:
             retry(
-                num_retries,
+                API_RETRIES,
                 partial(
-                    flickr.photos.addTags, photo_id=flickr_photo.id, tags=flickr_tags
+                    flickr.photos.setMeta,
+                    photo_id=photo_id,
+                    title=repair.title,
+                    timeout=timeout,
                 ),
             )
 
-        except Exception as e:
-            msg = f"Error replacing {filepath} ({flickr_photo.id}): {e}"
-            logger.error(msg)
+        if repair.location:
+            latitude, longitude = repair.location
+            retry(
+                API_RETRIES,
+                partial(
+                    flickr.photos.geo.setLocation,
+                    photo_id=photo_id,
+                    # max precision for the API
+                    lat=round(latitude, 6),
+                    lon=round(longitude, 6),
+                    timeout=timeout,
+                ),
+            )
+    except Exception as e:
+        msg = f"Error repairing {repair.filepath} ({photo_id}): {e}"
+        raise UploadError(msg) from e
+    return repair
 
 
+@metrics.stage("photostream check")
 def _get_uploaded_photos_indirect(
     flickr, number: int, since_time: datetime, margin_s=10
 ):
@@ -580,7 +1306,8 @@ def _get_uploaded_photos_indirect(
         limit=number,
         min_upload_date=date_s,
         sort="date-posted-desc",
-        extras="date_taken,tags",
+        # metadata to check for the incomplete uploads
+        extras="date_taken,tags,geo,url_o",
     ):
         photos_uploaded.append(photos)
 
@@ -615,6 +1342,7 @@ def _print_album_options(flickr, upload_options):
         logger.info("Not adding to album")
 
 
+@metrics.stage("set public")
 def _set_public(flickr, now_ts, photos_uploaded, parallel):
     logger.info("Setting photos to public...")
 
@@ -655,6 +1383,7 @@ def _set_public(flickr, now_ts, photos_uploaded, parallel):
     progress_bar.close()
 
 
+@metrics.stage("set dates")
 def _set_date_posted(flickr, now_ts, photos_uploaded, parallel):
     # so the photos appear in order in the photostream
     logger.info("Resetting upload dates...")
@@ -695,22 +1424,25 @@ def _set_date_posted(flickr, now_ts, photos_uploaded, parallel):
     progress_bar.close()
 
 
-def _add_to_album(flickr, upload_options, photo_uploaded_ids, parallel):
-    """Will add to album if album ID has been passed or new album created"""
+@metrics.stage("album edit")
+def _add_to_album(flickr, upload_options, uploaded_photos, parallel):
+    """Will add to album if album ID has been passed or new album created
+
+    uploaded_photos: need id and datetaken (to insert in date order)
+    """
     album_id = upload_options.album_id
     primary_photo_id = None
     if upload_options.is_create_album and not album_id:
-        primary_photo_id = photo_uploaded_ids[0]
+        primary_photo_id = uploaded_photos[0].id
         logger.info(f"Creating album with primary photo {primary_photo_id} ...")
         album_id = create_album(flickr, upload_options, primary_photo_id)
         logger.info(f"Album created with id {album_id}")
 
     if album_id:
-        logger.info(f"Adding photos to album {album_id}...")
-        _add_to_album_group(flickr, album_id, photo_uploaded_ids)
+        logger.info(f"Adding photos to album {album_id} (in date order)...")
+        _add_to_album_group(flickr, album_id, uploaded_photos)
 
-        logger.info("Reordering album...")
-        _reorder_album(flickr, album_id)
+    return album_id
 
 
 def _add_to_album_one_by_one(
@@ -743,20 +1475,29 @@ def _add_to_album_one_by_one(
     progress_bar.close()
 
 
-def _add_to_album_group(flickr, album_id, photo_uploaded_ids):
+def _add_to_album_group(flickr, album_id, uploaded_photos):
     # Get existing photos in the album
-    album_photos = retry(API_RETRIES, partial(get_photos, flickr, album_id))
+    album_photos = retry(
+        API_RETRIES, partial(get_photos, flickr, album_id, extras="date_taken")
+    )
 
     # Find the primary photo
     primary_photo_id = None
-    existing_photo_ids = []
+    existing_photo_ids = set()
     for photo in album_photos:
-        existing_photo_ids.append(photo.id)
+        existing_photo_ids.add(photo.id)
         if photo.isprimary == "1" or photo.isprimary == 1:
             primary_photo_id = photo.id
 
-    # Combine existing + new photo ids
-    all_photo_ids = existing_photo_ids + list(photo_uploaded_ids)
+    # merge the new photos (primary of a new album already in) into the date order
+    # of the album : editPhotos keeps the order of the IDs so no reorder needed after
+    new_photos = [p for p in uploaded_photos if p.id not in existing_photo_ids]
+    all_photos = sorted(album_photos + new_photos, key=attrgetter("datetaken"))
+    all_photo_ids = [p.id for p in all_photos]
+
+    if all_photo_ids == [p.id for p in album_photos]:
+        logger.info("Album already up to date")
+        return
 
     # Use editPhotos to add all new photos at once
     q_photo_ids = ",".join(all_photo_ids)
@@ -767,17 +1508,6 @@ def _add_to_album_group(flickr, album_id, photo_uploaded_ids):
     )
 
 
-def _reorder_album(flickr, album_id):
-    # get everything in the album and reorder it: tried with only passing the new
-    # uploads but weird result
-    album_photos = retry(API_RETRIES, partial(get_photos, flickr, album_id))
-    photos = sorted(album_photos, key=attrgetter("datetaken"))
-    photo_ids = list(map(attrgetter("id"), photos))
-
-    q_photo_ids = ",".join(photo_ids)
-    flickr.photosets.reorderPhotos(photoset_id=album_id, photo_ids=q_photo_ids)
-
-
 # to upload photos that are missing
 # for now : only album
 @upload.command("diff", cls=CatchAllExceptionsCommand)
@@ -851,16 +1581,18 @@ def diff(folder, filter_label, is_yes, **kwargs):
     progress_bar.close()
 
 
+@metrics.stage("exif sort")
 def order_by_date(files_to_upload):
     return sorted(files_to_upload, key=date_taken_key)
 
 
 def date_taken_key(x):
     filepath, _ = x
-    exif_data = piexif.load(filepath)
-    dt_original = exif_data["Exif"][piexif.ExifIFD.DateTimeOriginal]
+    dt_original = read_date_taken(filepath)
+    if not dt_original:
+        raise ValidationError(f"No EXIF date taken in {filepath}")
     # should be string orderable
-    return dt_original.decode("ascii")
+    return dt_original
 
 
 def generate_timestamps(now_ts, num_photos):
@@ -880,40 +1612,92 @@ def generate_timestamps(now_ts, num_photos):
 # Error calling Flickr API: HTTPSConnectionPool(host='up.flickr.com', port=443):
 # Read timed out. (read timeout=15)
 # Still photo is uploaded.
-# No change with timeout set to 45 => To correct : check the last upload since no id ?
-# how to search # if multiple threads
-# try 30: but already tried, no change
+# => before sending again, the retry policy checks if the photo is already in the
+# photostream (same title and date taken, uploaded since the first attempt)
 def upload_to_flickr(flickr, upload_options, order, filepath, xmp_root, timeout=30):
     title = get_title(xmp_root)
     tags = get_tags(xmp_root)
     flickr_tags = format_tags(tags)
+    start_ts = int(datetime.now().timestamp())
+
+    data = None
+    if upload_options.max_size or upload_options.quality:
+        # in memory: nothing written to the photo folder
+        with tracer.span(os.path.basename(filepath), "transcode", order=order):
+            data = transcode(filepath, upload_options.max_size, upload_options.quality)
+        if data is not None and _upload_saved is not None:
+            with _upload_saved.get_lock():
+                _upload_saved.value += os.path.getsize(filepath) - len(data)
 
     def upload():
-        # for some reason the default JSON format is not working, only XML
-        # so ask for etree for parsing
-        resp = flickr.upload(
-            filename=filepath,
-            title=title,
-            tags=flickr_tags,
-            # if public : set in a later operation
-            is_public=0,
-            format="etree",
-            timeout=timeout,
-            **{"async": 1},
-        )
+        # streamed from the file (flickrapi would open it and not close it)
+        with ProgressFile(filepath, _upload_progress, data) as fileobj:
+            try:
+                # for some reason the default JSON format is not working, only XML
+                # so ask for etree for parsing
+                resp = flickr.upload(
+                    filename=filepath,
+                    fileobj=fileobj,
+                    title=title,
+                    tags=flickr_tags,
+                    # if public : set in a later operation
+                    is_public=0,
+                    format="etree",
+                    timeout=timeout,
+                    **{"async": 1},
+                )
+            except Exception:
+                # will be sent again or not uploaded
+                fileobj.rollback()
+                raise
         return resp
 
+    check_sent = partial(_find_uploaded_photo, flickr, filepath, title, start_ts)
     try:
-        resp = retry(API_RETRIES, upload)
+        with tracer.span(os.path.basename(filepath), "upload file", order=order):
+            resp = retry(API_RETRIES, upload, method="upload", check_sent=check_sent)
+        if isinstance(resp, AlreadyUploaded):
+            # found already uploaded: no ticket to check
+            return order, None, filepath, resp.photo_id
         ticket_id = resp.find("ticketid").text
         # return filepath since inputs can be missing from outputs if error so not
         # aligned
-        return order, ticket_id, filepath
+        return order, ticket_id, filepath, None
     except Exception as e:
         msg = f"Error uploading file {filepath}: {e}"
         raise UploadError(msg) from e
 
 
+def _find_uploaded_photo(flickr, filepath, title, since_ts):
+    """AlreadyUploaded for the photo uploaded from filepath since since_ts or None
+
+    Only if there is a single match, so no risk of using a different photo.
+    """
+    date_taken = read_date_taken(filepath)
+    if not date_taken:
+        return None
+    date_taken = to_flickr_date(date_taken)
+    # without title, Flickr uses the file name
+    titles = {title} if title else {"", Path(filepath).stem}
+    resp = Addict(
+        flickr.photos.search(
+            user_id="me",
+            min_upload_date=since_ts - UPLOAD_SEARCH_MARGIN,
+            extras="date_taken",
+            per_page=MAX_PER_PAGE,
+        )
+    )
+    matches = [
+        photo.id
+        for photo in resp.photos.photo
+        if photo.title in titles and photo.datetaken == date_taken
+    ]
+    if len(matches) == 1:
+        return AlreadyUploaded(matches[0])
+    return None
+
+
+@metrics.stage("xmp scan")
 def filtered(folder, filter_label):
     files_to_upload = []
     for file_name in os.listdir(folder):
@@ -946,31 +1730,6 @@ def index_by_did(files_set):
     return file_index_by_id
 
 
-def retry(num_retries, func, error_callack=None):
-    retry = num_retries
-    while retry > 0:
-        try:
-            return func()
-        except Exception as ex:
-            # put error : case of mulitple uploads : not sure if silent error in Flickr
-            # API or case of an error is returned but the photo is still uploaded
-            # check
-            # TODO see if formatting problem with progress bar
-            if PRINT_API_ERROR:
-                logger.warning(f"Error calling Flickr API: {ex}\nRetry ...")
-            if error_callack:
-                return_now, raise_now = error_callack(ex)
-                if return_now:
-                    return None
-                if raise_now:
-                    raise
-            retry -= 1
-            if retry > 0:
-                sleep(API_RETRY_DELAY)
-                continue
-            raise
-
-
 def create_album(flickr, upload_options, primary_photo_id):
     try:
         # create album using Flicker api
@@ -981,7 +1740,25 @@ def create_album(flickr, upload_options, primary_photo_id):
                 primary_photo_id=primary_photo_id,
             )
 
-        resp = Addict(retry(API_RETRIES, func))
+        def check_sent():
+            # the album may have been created despite the error: most recent first
+            resp = Addict(flickr.photosets.getList(per_page=10))
+            for album_data in resp.photosets.photoset:
+                if (
+                    album_data.title._content == upload_options.album_name
+                    and album_data.primary == primary_photo_id
+                ):
+                    return {"photoset": {"id": album_data.id}}
+            return None
+
+        resp = Addict(
+            retry(
+                API_RETRIES,
+                func,
+                method="flickr.photosets.create",
+                check_sent=check_sent,
+            )
+        )
         album_id = resp.photoset.id
         return album_id
     except Exception as e:
@@ -1002,16 +1779,10 @@ def add_to_album(flickr, album_id, photo_id):
                 timeout=timeout,
             )
 
-        def error_callack(ex: Exception):
-            # usually means a 500 error was received when adding a photo but the photo
-            # was actually successfully added to album
-            msg = str(ex)
-            if "Error: 3: Photo already in set" in msg:
-                return True, False
-
-            return False, False
-
-        retry(API_RETRIES, func, error_callack)
+        # "Photo already in set" is skipped by the retry policy: usually means a 500
+        # error was received when adding a photo but the photo was actually
+        # successfully added to album
+        retry(API_RETRIES, func, method="flickr.photosets.addPhoto")
 
     except Exception as e:
         msg = f"Error adding photo {photo_id} to album {album_id}: {e}"
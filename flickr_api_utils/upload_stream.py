@@ -0,0 +1,110 @@
+from io import BytesIO
+import os
+import threading
+
+from .bandwidth import throttle
+
+# max bytes read from the file at once
+CHUNK_SIZE = 1024 * 1024
+
+# seconds
+PROGRESS_POLL_INTERVAL = 0.5
+
+
+class ProgressFile:
+    """File to upload, read by chunks with the number of bytes read reported
+
+    Passed as fileobj to flickr.upload / flickr.replace: the multipart body is read
+    from it by the encoder while sending so only a chunk of the file is in memory.
+
+    progress: shared multiprocessing.Value (bytes sent by all the workers) or None
+    data: content to send instead of the file (transcoded photo) read from memory
+    """
+
+    def __init__(self, filepath, progress=None, data=None):
+        if data is None:
+            self.f = open(filepath, "rb")
+            self.size = os.path.getsize(filepath)
+        else:
+            self.f = BytesIO(data)
+            self.size = len(data)
+        self.progress = progress
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > CHUNK_SIZE:
+            # the encoder calls again until the end of the file
+            size = CHUNK_SIZE
+        data = self.f.read(size)
+        self._add(len(data))
+        # read as the request is sent: waiting here slows down the upload
+        throttle(len(data))
+        return data
+
+    # used by the encoder to compute the length of the body
+    def __len__(self):
+        return self.size
+
+    # the encoder wraps objects with a fileno (raises for data in memory)
+    def fileno(self):
+        return self.f.fileno()
+
+    def tell(self):
+        return self.f.tell()
+
+    def rollback(self):
+        """Remove the bytes read from the progress (the upload will be sent again)"""
+        self._add(-self.bytes_read)
+
+    def _add(self, num_bytes):
+        self.bytes_read += num_bytes
+        if self.progress is not None and num_bytes:
+            with self.progress.get_lock():
+                self.progress.value += num_bytes
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProgressPoller:
+    """Update a tqdm progress bar (in bytes) from a shared counter in a thread
+
+    saved: shared multiprocessing.Value (bytes removed from the total by transcoding
+    the files before sending) or None
+    """
+
+    def __init__(self, progress, progress_bar, saved=None):
+        self.progress = progress
+        self.progress_bar = progress_bar
+        self.saved = saved
+        self._total = progress_bar.total
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._last = 0
+
+    def _run(self):
+        while not self._stop.wait(PROGRESS_POLL_INTERVAL):
+            self._update()
+
+    def _update(self):
+        if self.saved is not None and self.saved.value:
+            self.progress_bar.total = self._total - self.saved.value
+        value = self.progress.value
+        # can go back if an upload is retried
+        self.progress_bar.update(value - self._last)
+        self._last = value
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self._update()
@@ -0,0 +1,141 @@
+from datetime import datetime
+import ipaddress
+import json
+import logging
+import os
+import socket
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# in the current directory like the token cache
+TUNING_FILE = ".upload_tuning.json"
+
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 8
+DEFAULT_CONCURRENCY = 2
+
+# error rate in a window above which the concurrency is reduced
+MAX_ERROR_RATE = 0.1
+# relative throughput change under which 2 windows are considered the same
+MIN_GAIN = 0.05
+
+UPLOAD_HOST = "up.flickr.com"
+
+
+def network_key():
+    """Identifier of the current network: subnet of the local address to Flickr
+
+    Nothing is sent (UDP connect only selects the route).
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((UPLOAD_HOST, 443))
+            local_ip = s.getsockname()[0]
+        return str(ipaddress.ip_network(f"{local_ip}/24", strict=False))
+    except OSError:
+        return "default"
+
+
+class ConcurrencyTuner:
+    """Hill climbing on the number of concurrent uploads
+
+    The aggregate throughput (bytes/s of completed uploads) is measured over windows
+    of completed uploads. After each window, the concurrency moves one step in the
+    same direction if the throughput improved, else in the other direction. It goes
+    down if too many uploads failed.
+    """
+
+    def __init__(
+        self,
+        concurrency,
+        min_concurrency=MIN_CONCURRENCY,
+        max_concurrency=MAX_CONCURRENCY,
+    ):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = self._bounded(concurrency)
+        self.direction = 1
+        self.best = None
+        self._last_throughput = None
+        self._start_window()
+
+    def _bounded(self, concurrency):
+        return max(self.min_concurrency, min(self.max_concurrency, concurrency))
+
+    def _start_window(self):
+        self._window_start = monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_errors = 0
+
+    @property
+    def window_size(self):
+        # enough completions for the measure to cover all the slots a few times
+        return max(4, 2 * self.concurrency)
+
+    def record(self, size, is_error=False):
+        """Record a finished upload ; True if the concurrency was changed"""
+        self._window_count += 1
+        if is_error:
+            self._window_errors += 1
+        else:
+            self._window_bytes += size
+
+        if self._window_count < self.window_size:
+            return False
+
+        elapsed = max(monotonic() - self._window_start, 1e-3)
+        throughput = self._window_bytes / elapsed
+        error_rate = self._window_errors / self._window_count
+        previous = self.concurrency
+
+        if error_rate <= MAX_ERROR_RATE and (
+            not self.best or throughput > self.best[1]
+        ):
+            self.best = (self.concurrency, throughput)
+
+        if error_rate > MAX_ERROR_RATE:
+            # link or Flickr overloaded
+            self.direction = -1
+        elif (
+            self._last_throughput is not None
+            and throughput < self._last_throughput * (1 + MIN_GAIN)
+        ):
+            # no gain from the last step : try the other way
+            self.direction = -self.direction
+
+        self._last_throughput = throughput
+        self.concurrency = self._bounded(self.concurrency + self.direction)
+        logger.debug(
+            f"Upload window: {throughput / 1e6:.2f} MB/s, {error_rate:.0%} errors "
+            f"with {previous} uploads => {self.concurrency}"
+        )
+        self._start_window()
+        return self.concurrency != previous
+
+    @property
+    def best_concurrency(self):
+        if self.best:
+            return self.best[0]
+        return self.concurrency
+
+
+def load_concurrency(key, path=TUNING_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        tuning = json.load(f)
+    if key in tuning:
+        return tuning[key]["concurrency"]
+    return None
+
+
+def save_concurrency(key, concurrency, path=TUNING_FILE):
+    tuning = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            tuning = json.load(f)
+    tuning[key] = dict(concurrency=concurrency, updated=datetime.now().isoformat())
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tuning, f, indent=2)
@@ -0,0 +1,69 @@
+from functools import partial
+import json
+import multiprocessing
+from multiprocessing import util
+import os
+import shutil
+import tempfile
+
+# (func, args) run at the start of each pool worker: registered by the main process
+# before the pools are created, so the workers also report their instrumentation
+_worker_setups = []
+
+
+def register_worker_setup(func, *args):
+    _worker_setups.append((func, args))
+
+
+def register_worker_collector(prefix, collect, merge, setup=None):
+    """Collect data in each pool worker and merge it in the main process
+
+    setup(): run at the start of each worker (like resetting what was copied from
+    the main process by the fork)
+    collect(): JSON-serializable data of the worker, called when it exits
+    merge(data): called in the main process for the data of each worker
+
+    Returns the function to call in the main process once the pools are joined: it
+    merges the data of all the workers.
+    """
+    workers_dir = tempfile.mkdtemp(prefix=f"fau-{prefix}-")
+    register_worker_setup(_init_collector, workers_dir, collect, setup)
+    return partial(_merge_workers, workers_dir, merge)
+
+
+def _init_collector(workers_dir, collect, setup):
+    if setup:
+        setup()
+    # run when the worker exits normally (pool closed and joined)
+    util.Finalize(None, _dump_worker, args=(workers_dir, collect), exitpriority=10)
+
+
+def _dump_worker(workers_dir, collect):
+    path = os.path.join(workers_dir, f"{os.getpid()}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(collect(), f)
+
+
+def _merge_workers(workers_dir, merge):
+    for name in sorted(os.listdir(workers_dir)):
+        with open(os.path.join(workers_dir, name), encoding="utf-8") as f:
+            merge(json.load(f))
+    shutil.rmtree(workers_dir, ignore_errors=True)
+
+
+def _init_worker(worker_setups, initializer, initargs):
+    for func, args in worker_setups:
+        func(*args)
+    if initializer:
+        initializer(*initargs)
+
+
+def Pool(processes=None, initializer=None, initargs=()):
+    """multiprocessing.Pool running the registered worker setups in each worker
+
+    The pool must be closed and joined (not terminated) so the workers exit normally
+    and can write what they collected.
+    """
+    return multiprocessing.Pool(
+        processes, _init_worker, (list(_worker_setups), initializer, initargs)
+    )